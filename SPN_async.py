@@ -0,0 +1,204 @@
+import asyncio
+import threading
+import time
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+
+from SPN_functions import compile_SPN, solve_SPN
+from SPN_results import ResultCache
+
+
+# ----- asyncio front-end -----
+
+# for servers answering many concurrent requests, often the same ones.
+#     sim = await simulate(G_SIRDS, rates, inits, (0, 365))
+# runs solve_SPN on a bounded executor (threads by default, or any
+# concurrent.futures executor, e.g. a process pool) without blocking the
+# event loop.  identical requests in flight (same model structure, rates,
+# inits, times, solver) share one solve.  at most max_queue distinct
+# solves are pending at once; further callers wait for a slot, or with
+# block=False get asyncio.QueueFull.  cancelling a caller only cancels
+# the solve if no other caller is waiting for it and it has not started.
+# the service is thread safe, and can be shared between event loops.
+
+# key functions:
+#     service = SimulationService(max_workers=4, max_queue=64)
+#     await service.simulate(model, rates, inits, t_span)
+#     service.metrics()
+#     returns dict of queue depth, running, counts (solves, coalesced,
+#     rejected, cancelled, failed) and latency quantiles in seconds
+
+#     await simulate(model, rates, inits, t_span)
+#     the same on a default service
+
+def _solve(model, rates, inits, t_span, t_eval, method, rtol, atol):
+    return solve_SPN(model, inits, t_span[0], t_span[1], method=method, rtol=rtol,
+                     atol=atol, params=rates, t_eval=t_eval)
+
+
+class _Solve:
+    # a solve in flight and the number of callers waiting for it
+    __slots__ = ('future', 'waiters')
+
+    def __init__(self):
+        self.future = None
+        self.waiters = 0
+
+
+class SimulationService:
+    def __init__(self, max_workers=4, max_queue=64, executor=None, n_latencies=1000):
+        # INPUT: executor to run solves on, default a pool of max_workers
+        #        threads (shut down by close(); a given one is not)
+        #        max_queue distinct solves pending (queued or running)
+        #        n_latencies recent request latencies kept for metrics
+        self.max_queue = max_queue
+        self._own = executor is None
+        self.executor = ThreadPoolExecutor(max_workers) if executor is None else executor
+        # reentrant, as a solve that is already done runs its callback
+        # straight from add_done_callback
+        self._lock = threading.RLock()
+        self._inflight = {}
+        self._slot_waiters = deque()
+        self._latencies = deque(maxlen=n_latencies)
+        self.counts = {'requests': 0, 'solves': 0, 'coalesced': 0, 'rejected': 0,
+                       'cancelled': 0, 'failed': 0}
+
+    def _key(self, model, rates, inits, t_span, t_eval, method, rtol, atol):
+        return ResultCache.key(model.key, rates, inits, tuple(t_span),
+                               None if t_eval is None else np.asarray(t_eval, dtype=float),
+                               method, rtol, atol)
+
+    async def _slot(self, block):
+        # waits until fewer than max_queue solves are pending; called
+        # holding no lock, returns holding self._lock
+        loop = asyncio.get_running_loop()
+        while True:
+            self._lock.acquire()
+            if len(self._inflight) < self.max_queue:
+                return
+            if not block:
+                self.counts['rejected'] += 1
+                self._lock.release()
+                raise asyncio.QueueFull(f"{len(self._inflight)} simulations pending")
+            waiter = loop.create_future()
+            self._slot_waiters.append((loop, waiter))
+            self._lock.release()
+            try:
+                await waiter
+            except asyncio.CancelledError:
+                # this caller may already have been woken for a free
+                # slot, which would be lost, so pass it on
+                with self._lock:
+                    self.counts['cancelled'] += 1
+                    self._wake()
+                raise
+
+    def _wake(self):
+        # with self._lock held: lets the next waiting caller try for a slot
+        while self._slot_waiters:
+            loop, waiter = self._slot_waiters.popleft()
+            if waiter.done():
+                # cancelled while waiting
+                continue
+            try:
+                loop.call_soon_threadsafe(lambda w=waiter: w.done() or w.set_result(None))
+                return
+            except RuntimeError:
+                # its loop is closed
+                pass
+
+    def _done(self, key, entry):
+        with self._lock:
+            if self._inflight.get(key) is entry:
+                del self._inflight[key]
+            if not entry.future.cancelled() and entry.future.exception() is not None:
+                self.counts['failed'] += 1
+            self._wake()
+
+    async def simulate(self, model, rates=None, inits=None, t_span=(0, 365), t_eval=None,
+                       method='RK45', rtol=1e-9, atol=1e-12, block=True):
+        # INPUT: model graph or CompiledSPN
+        #        rates vector, dict of overrides by param or transaction
+        #              name (as with_rates), or None for the model's own
+        #        block wait for a slot when max_queue solves are pending,
+        #              or raise asyncio.QueueFull
+        # OUTPUT: solve_SPN result; shared between coalesced callers, so
+        #         treat it as read only
+        start = time.perf_counter()
+        model = compile_SPN(model)
+        if isinstance(rates, dict):
+            rates = model.with_rates(**rates).rates
+        rates = model.rates if rates is None else np.asarray(rates, dtype=float)
+        inits = np.asarray(inits, dtype=float)
+        key = self._key(model, rates, inits, t_span, t_eval, method, rtol, atol)
+
+        self._lock.acquire()
+        self.counts['requests'] += 1
+        entry = self._inflight.get(key)
+        if entry is None:
+            self._lock.release()
+            await self._slot(block)
+            # another caller may have started the same solve meanwhile, in
+            # which case the slot goes to the next in line
+            entry = self._inflight.get(key)
+            if entry is not None:
+                self._wake()
+        try:
+            if entry is None:
+                entry = _Solve()
+                entry.future = self.executor.submit(_solve, model, rates, inits, t_span,
+                                                    t_eval, method, rtol, atol)
+                self._inflight[key] = entry
+                self.counts['solves'] += 1
+                entry.future.add_done_callback(lambda f: self._done(key, entry))
+            else:
+                self.counts['coalesced'] += 1
+            entry.waiters += 1
+        finally:
+            self._lock.release()
+
+        try:
+            return await asyncio.shield(asyncio.wrap_future(entry.future))
+        except asyncio.CancelledError:
+            with self._lock:
+                self.counts['cancelled'] += 1
+                entry.waiters -= 1
+                if entry.waiters == 0:
+                    # only stops it if it is still queued in the executor
+                    entry.future.cancel()
+            raise
+        finally:
+            with self._lock:
+                self._latencies.append(time.perf_counter() - start)
+
+    def metrics(self):
+        with self._lock:
+            running = sum(e.future.running() for e in self._inflight.values())
+            latencies = np.array(self._latencies)
+            out = dict(self.counts, pending=len(self._inflight), running=running,
+                       queued=len(self._inflight) - running,
+                       waiting_for_slot=len(self._slot_waiters), max_queue=self.max_queue)
+        if len(latencies):
+            out.update(zip(('latency_p50', 'latency_p90', 'latency_p99'),
+                           np.quantile(latencies, (0.5, 0.9, 0.99))))
+            out['latency_max'] = latencies.max()
+        return out
+
+    def close(self, wait=True):
+        if self._own:
+            self.executor.shutdown(wait=wait, cancel_futures=not wait)
+
+
+default_service = None
+_default_lock = threading.Lock()
+
+
+async def simulate(model, rates=None, inits=None, t_span=(0, 365), **kwargs):
+    # simulate on a default service, started on first use
+    global default_service
+    with _default_lock:
+        if default_service is None:
+            default_service = SimulationService()
+    return await default_service.simulate(model, rates, inits, t_span, **kwargs)
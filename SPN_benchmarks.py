@@ -0,0 +1,280 @@
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+import tracemalloc
+
+import matplotlib
+matplotlib.use('Agg')
+import matplotlib.pyplot as plt
+import numpy as np
+import scipy
+
+import SPN_functions as spn
+from SPN_stochastic import gillespie_SPN, tau_leap_SPN
+from SPN_stratify import compile_stratified, stratify_SPN
+from model_graphs import G_SIR, G_SIRD, G_SIRDS, G_SIRDS2
+
+
+# ----- benchmarks -----
+
+# times (best of a few repeats) and peak traced memory of the main paths:
+# code generation and compiling, rate function calls, solve_SPN, copying,
+# LaTeX, drawing and the stochastic simulations, for the models in
+# model_graphs.py and for stratified SIRDS at increasing numbers of groups.
+# solve_BDF_full and solve_BDF_reduced compare BDF with and without the
+# reduction of SPN_reduce.py, up to reduce_sizes groups.
+
+# usage:
+#     python SPN_benchmarks.py --out bench.json
+#     python SPN_benchmarks.py --out new.json --baseline bench.json
+# the second flags (and exits 1 on) anything slower than the baseline
+# by more than --threshold (default 25%), or using more peak memory by
+# more than --mem-threshold (default 25%)
+
+# cold import times are measured too, against a budget.  each module is
+# imported in a fresh interpreter after what it needs anyway (NumPy and
+# scipy.integrate for SPN_functions, networkx for model_graphs), and only
+# its own import is timed, the median of 5 runs.  SPN_functions must not
+# import matplotlib or networkx, and each may take at most import_budget
+# seconds.  anything over budget also exits 1
+
+models = {'SIR': G_SIR, 'SIRD': G_SIRD, 'SIRDS': G_SIRDS, 'SIRDS2': G_SIRDS2}
+strata_sizes = (2, 5, 10, 20)
+# larger sizes for the implicit solves only, where reducing pays off
+reduce_sizes = (128,)
+
+
+def _strata(n):
+    groups = [f"g{i}" for i in range(n)]
+    # mostly within-group contact, with the same row sums at every n
+    contact = n * (np.eye(n) + 0.2 / n) / 1.2
+    return groups, contact
+
+
+def _inits(model):
+    # small infection in the first group, everyone else susceptible
+    n = len(model.species)
+    x = np.zeros(n)
+    s = [i for i, name in enumerate(model.species) if name.startswith('S')]
+    x[s] = 1 / len(s)
+    i0 = model.species.index('I' + model.species[s[0]][1:])
+    x[s[0]] -= 3e-8
+    x[i0] = 3e-8
+    return x
+
+
+def measure(fun, repeat=3, min_time=0.05):
+    # OUTPUT: dict with best time per call (s), calls per timing, and peak
+    #         traced memory (kB) of a single call
+    tracemalloc.start()
+    fun()
+    peak = tracemalloc.get_traced_memory()[1]
+    tracemalloc.stop()
+    number = 1
+    while True:
+        t = time.perf_counter()
+        for _ in range(number):
+            fun()
+        t = time.perf_counter() - t
+        if t >= min_time or number >= 1e6:
+            break
+        number *= 10
+    best = t / number
+    for _ in range(repeat - 1):
+        t = time.perf_counter()
+        for _ in range(number):
+            fun()
+        best = min(best, (time.perf_counter() - t) / number)
+    return {'time_s': best, 'number': number, 'peak_kB': peak / 1024}
+
+
+import_budget = 0.15
+heavy_modules = ('matplotlib', 'networkx')
+# module -> what it needs anyway, imported first and not counted
+import_cases = {'SPN_functions': 'numpy, scipy.integrate',
+                'model_graphs': 'networkx'}
+
+
+def cold_import(module, base='', repeat=5):
+    # OUTPUT: dict with the median time (s), over repeat new interpreters,
+    #         to import module once base is imported (its own time, so
+    #         not swayed by how long base takes that run), base_s the
+    #         median time of base, peak traced memory (kB) of the import
+    #         of module (from one more run, as tracing slows it), and the
+    #         heavy modules it loaded
+    def run(trace):
+        code = ("import sys, time, tracemalloc\n"
+                "t = time.perf_counter()\n"
+                f"{'import ' + base if base else ''}\n"
+                "t_base = time.perf_counter() - t\n"
+                "before = set(sys.modules)\n"
+                f"{'tracemalloc.start()' if trace else ''}\n"
+                "t = time.perf_counter()\n"
+                f"import {module}\n"
+                "t = time.perf_counter() - t\n"
+                "print(t, t_base, tracemalloc.get_traced_memory()[1],\n"
+                f"      *[m for m in {heavy_modules!r} if m in set(sys.modules) - before])")
+        out = subprocess.run([sys.executable, '-c', code], capture_output=True, text=True,
+                             check=True, cwd=os.path.dirname(os.path.abspath(__file__)))
+        t, t_base, peak, *loaded = out.stdout.split()
+        return float(t), float(t_base), float(peak), loaded
+
+    runs = [run(False) for _ in range(repeat)]
+    peak = run(True)[2]
+    return {'time_s': float(np.median([r[0] for r in runs])), 'number': 1,
+            'base_s': float(np.median([r[1] for r in runs])), 'peak_kB': peak / 1024,
+            'loaded': runs[0][3]}
+
+
+def import_benchmarks():
+    return {f"import/{name}": cold_import(name, base) for name, base in import_cases.items()}
+
+
+def check_imports(results, budget=import_budget):
+    # OUTPUT: list of messages for each import over budget
+    over = []
+    res = results['results']
+    for name, base in import_cases.items():
+        r = res.get(f"import/{name}")
+        if r is None:
+            continue
+        if name == 'SPN_functions' and r['loaded']:
+            over.append(f"{name} imports {', '.join(r['loaded'])}")
+        if r['time_s'] > budget:
+            over.append(f"{name} takes {r['time_s']:.3f} s after {base}, over {budget} s")
+    return over
+
+
+def _draw(G):
+    spn.draw_SPN(G)
+    plt.close('all')
+
+
+def model_benchmarks(name, G, draw=True):
+    model = spn.compile_SPN(G, cache=False)
+    x = _inits(model)
+    fun = spn.python_rate_fun(G)
+    rate_fun = model.rate_fun()
+    res = {
+        'python_rate_fun': measure(lambda: spn.python_rate_fun(G)),
+        'compile_SPN': measure(lambda: spn.compile_SPN(G, cache=False)),
+        'compile_SPN_cached': measure(lambda: spn.compile_SPN(G)),
+        'rhs_codegen': measure(lambda: fun(0, x)),
+        'rhs_compiled': measure(lambda: rate_fun(0, x)),
+        'solve_SPN': measure(lambda: spn.solve_SPN(G, x), repeat=2),
+        'solve_SPN_LSODA': measure(lambda: spn.solve_SPN(G, x, method='LSODA', rtol=1e-6, atol=1e-9), repeat=2),
+        'deep_copy_graph': measure(lambda: spn.deep_copy_graph(G)),
+        'with_rates': measure(lambda: model.with_rates(model.rates)),
+        'latex_code': measure(lambda: spn.latex_code(G)),
+    }
+    for key in ('rhs_codegen', 'rhs_compiled'):
+        res[key]['calls_per_s'] = 1 / res[key]['time_s']
+    if draw and 'pos' in G.graph:
+        res['draw_SPN'] = measure(lambda: _draw(G), repeat=1)
+    if name in ('SIR', 'SIRDS'):
+        counts = np.round(x * 1e4).astype(int)
+        res['gillespie_1e4'] = measure(lambda: gillespie_SPN(model, counts, seed=0), repeat=1)
+        counts = np.round(x * 1e6).astype(int)
+        res['tau_leap_100x1e6'] = measure(lambda: tau_leap_SPN(model, counts, n_reps=100, seed=0), repeat=1)
+    return {f"{name}/{k}": v for k, v in res.items()}
+
+
+def strata_benchmarks(n):
+    groups, contact = _strata(n)
+    res = model_benchmarks(f"SIRDS_x{n}", stratify_SPN(G_SIRDS, groups, contact), draw=n <= 5)
+    model = compile_stratified(G_SIRDS, groups, contact)
+    x = _inits(model)
+    rate_fun = model.rate_fun()
+    res[f"SIRDS_x{n}/compile_stratified"] = measure(lambda: compile_stratified(G_SIRDS, groups, contact))
+    res[f"SIRDS_x{n}/rhs_stratified"] = measure(lambda: rate_fun(0, x))
+    res[f"SIRDS_x{n}/solve_stratified"] = measure(lambda: spn.solve_SPN(model, x), repeat=2)
+    res.update(implicit_benchmarks(n, model))
+    return res
+
+
+def implicit_benchmarks(n, model=None):
+    # BDF on the full system and on the one reduced by sinks and
+    # conservation laws (solve_SPN's default for implicit methods)
+    if model is None:
+        model = compile_stratified(G_SIRDS, *_strata(n))
+    x = _inits(model)
+    return {f"SIRDS_x{n}/solve_BDF_full":
+                measure(lambda: spn.solve_SPN(model, x, method='BDF', reduce=False), repeat=1),
+            f"SIRDS_x{n}/solve_BDF_reduced":
+                measure(lambda: spn.solve_SPN(model, x, method='BDF'), repeat=1)}
+
+
+def run_benchmarks(sizes=strata_sizes, progress=print):
+    progress("imports")
+    results = import_benchmarks()
+    for name, G in models.items():
+        progress(name)
+        results.update(model_benchmarks(name, G))
+    for n in sizes:
+        progress(f"SIRDS x {n} groups")
+        results.update(strata_benchmarks(n))
+    for n in reduce_sizes:
+        progress(f"SIRDS x {n} groups, implicit")
+        results.update(implicit_benchmarks(n))
+    meta = {'time': time.strftime('%Y-%m-%dT%H:%M:%S'),
+            'python': sys.version.split()[0], 'numpy': np.__version__,
+            'scipy': scipy.__version__, 'platform': platform.platform()}
+    return {'meta': meta, 'results': results}
+
+
+def compare(results, baseline, threshold=0.25, mem_threshold=0.25, min_kB=16):
+    # OUTPUT: list of (name, quantity, baseline, new) for each benchmark
+    #         slower than the baseline by more than threshold, or with
+    #         peak memory larger by more than mem_threshold (and min_kB,
+    #         as tiny peaks move by a few kB between runs)
+    worse = []
+    for name, new in results['results'].items():
+        old = baseline['results'].get(name)
+        if old is None:
+            continue
+        if new['time_s'] > old['time_s'] * (1 + threshold):
+            worse.append((name, 'time_s', old['time_s'], new['time_s']))
+        if new['peak_kB'] > max(old['peak_kB'] * (1 + mem_threshold), old['peak_kB'] + min_kB):
+            worse.append((name, 'peak_kB', old['peak_kB'], new['peak_kB']))
+    return worse
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Benchmark the SPN functions")
+    parser.add_argument('--out', default='bench.json', help="JSON file for the results")
+    parser.add_argument('--baseline', help="JSON results to compare against")
+    parser.add_argument('--threshold', type=float, default=0.25, help="allowed slowdown")
+    parser.add_argument('--mem-threshold', type=float, default=0.25,
+                        help="allowed increase in peak memory")
+    parser.add_argument('--sizes', type=int, nargs='*', default=list(strata_sizes),
+                        help="numbers of groups for stratified SIRDS")
+    args = parser.parse_args(argv)
+
+    results = run_benchmarks(args.sizes)
+    with open(args.out, 'w') as f:
+        json.dump(results, f, indent=1)
+    for name, r in results['results'].items():
+        print(f"{name:40s} {r['time_s']*1e3:12.4f} ms {r['peak_kB']:10.1f} kB")
+    over = check_imports(results)
+    for message in over:
+        print(f"OVER BUDGET {message}")
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        worse = compare(results, baseline, args.threshold, args.mem_threshold)
+        for name, quantity, old, new in worse:
+            if 'time_s' == quantity:
+                print(f"SLOWER {name}: {old*1e3:.4f} ms -> {new*1e3:.4f} ms")
+            else:
+                print(f"MORE MEMORY {name}: {old:.1f} kB -> {new:.1f} kB")
+        return 1 if worse or over else 0
+    return 1 if over else 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
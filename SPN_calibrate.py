@@ -0,0 +1,173 @@
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+from scipy.integrate import solve_ivp
+from scipy.optimize import OptimizeResult, least_squares
+
+from SPN_functions import compile_SPN, implicit_methods
+from SPN_sensitivity import _wrt_index, sensitivity_fun
+
+
+# ----- calibration -----
+
+# fits some of the rates of a model to observed series of some species,
+# e.g. I and D for G_SIRDS, by weighted least squares.  the model is
+# compiled once; each evaluation only swaps the rates vector, and solves
+# with LSODA and the exact Jacobian by default.  with jac='sensitivity'
+# the residuals and their derivatives come from one sensitivity_SPN style
+# solve, shared between the optimizer's calls for residuals and Jacobian
+# at the same point.  that is more accurate than the default '2-point',
+# though for a few rates of G_SIRDS finite differences are faster
+
+# several starts (the warm start, if given, then random points in the
+# bounds, log-uniform where the bounds are positive) run in parallel
+# across processes; the best fit is returned along with every start.
+
+# key function:
+#     calibrate_SPN(G, t_obs, observed, inits, fit, bounds)
+#     e.g. calibrate_SPN(G_SIRDS, t, {'I': I_obs, 'D': D_obs}, inits,
+#                        fit=['beta', 'gamma'], bounds=[(0, 2), (0, 1)])
+#     returns result with x (fitted rates in the order of fit), rates
+#     (full vector), model (compiled, with the fitted rates), cost,
+#     starts, nfev, njev and wall_time
+
+class _Residuals:
+    # residuals and Jacobian of one fit, remembering the last solve
+    def __init__(self, model, t0, t_obs, obs_idx, observed, weights, inits, idx,
+                 method, rtol, atol):
+        self.model, self.t0, self.t_obs = model, t0, t_obs
+        self.obs_idx, self.observed, self.weights = obs_idx, observed, weights
+        self.inits, self.idx = inits, idx
+        self.method, self.rtol, self.atol = method, rtol, atol
+        self.last = None
+        self.nsolve = 0
+
+    def rates(self, x):
+        rates = np.array(self.model.rates)
+        rates[self.idx] = x
+        return rates
+
+    def solve(self, x, sens):
+        if self.last is not None and np.array_equal(self.last[0], x) \
+                and (self.last[2] is not None or not sens):
+            return self.last[1], self.last[2]
+        model, rates = self.model, self.rates(x)
+        n, p = len(model.species), len(self.idx)
+        options = {}
+        if sens:
+            fun, jac = sensitivity_fun(model, rates, [model.params[k] for k in self.idx])
+            y0 = np.concatenate((self.inits, np.zeros(n * p)))
+            if self.method in implicit_methods:
+                options['jac'] = jac if self.method != 'LSODA' else lambda t, z: jac(t, z).toarray()
+        else:
+            fun, y0 = model.rate_fun(rates), self.inits
+            if self.method in implicit_methods:
+                options['jac'] = model.jac_fun(rates)
+        sim = solve_ivp(fun, (self.t0, self.t_obs[-1]), y0, method=self.method,
+                        rtol=self.rtol, atol=self.atol, t_eval=self.t_obs, **options)
+        self.nsolve += 1
+        if not sim.success or sim.y.shape[1] != len(self.t_obs):
+            y, S = np.full((n, len(self.t_obs)), np.inf), None
+        else:
+            y = sim.y[:n]
+            S = sim.y[n:].reshape(n, p, -1) if sens else None
+        self.last = (np.array(x), y, S)
+        return y, S
+
+    def fun(self, x, sens=False):
+        y, _ = self.solve(x, sens)
+        r = (y[self.obs_idx] - self.observed) * self.weights
+        return np.nan_to_num(r.ravel(), nan=1e100, posinf=1e100, neginf=-1e100)
+
+    def jac(self, x):
+        _, S = self.solve(x, True)
+        if S is None:
+            return np.zeros((self.observed.size, len(self.idx)))
+        # S[species, param, time] -> rows ordered as the residuals
+        J = S[self.obs_idx] * self.weights[:, None, :]
+        return J.transpose(0, 2, 1).reshape(-1, len(self.idx))
+
+
+def _fit_start(residuals, x0, bounds, jac, options):
+    start, nsolve = time.perf_counter(), residuals.nsolve
+    if 'sensitivity' == jac:
+        res = least_squares(lambda x: residuals.fun(x, True), x0, jac=residuals.jac,
+                            bounds=bounds, **options)
+    else:
+        res = least_squares(residuals.fun, x0, jac=jac, bounds=bounds, **options)
+    return OptimizeResult(x0=x0, x=res.x, cost=res.cost, success=res.success,
+                          status=res.status, message=res.message, nfev=res.nfev,
+                          njev=res.njev or 0, nsolve=residuals.nsolve - nsolve,
+                          time=time.perf_counter() - start)
+
+
+def _starts(x_start, lower, upper, n_starts, rng):
+    starts = [] if x_start is None else [np.clip(x_start, lower, upper)]
+    log = (lower > 0) & np.isfinite(upper)
+    while len(starts) < n_starts:
+        u = rng.random(len(lower))
+        x = np.where(log, lower * (upper / np.where(log, lower, 1)) ** u,
+                     lower + u * (upper - lower))
+        starts.append(x)
+    return starts
+
+
+def calibrate_SPN(G, t_obs, observed, inits, fit=None, bounds=None, t0=0,
+                  weights=None, warm_start=None, n_starts=8, seed=None,
+                  max_workers=None, jac='2-point', method='LSODA',
+                  rtol=1e-8, atol=1e-12, **options):
+    # INPUT: graph G or CompiledSPN
+    #        t_obs observation times (> t0), observed dict species name ->
+    #              values at t_obs
+    #        fit names of rates to fit (params or transactions), default all
+    #        bounds (lower, upper) per fitted rate, default (0, 10 x rate)
+    #        weights dict species name -> weight (scalar or per time),
+    #                default 1 / max of each observed series
+    #        warm_start previous result or rates in the order of fit; the
+    #                   first start, and if n_starts=1 the only one
+    #        max_workers processes for the starts (1 runs them here)
+    #        jac a least_squares jac such as '2-point', or 'sensitivity'
+    #        options passed to least_squares (ftol, xtol, max_nfev, ...)
+    # OUTPUT: OptimizeResult as above
+    wall = time.perf_counter()
+    model = compile_SPN(G)
+    idx = _wrt_index(model, fit)
+    t_obs = np.asarray(t_obs, dtype=float)
+    names = list(observed)
+    obs_idx = [model.species.index(s) for s in names]
+    obs = np.array([np.broadcast_to(np.asarray(observed[s], dtype=float), t_obs.shape)
+                    for s in names])
+    if weights is None:
+        weights = {s: 1 / max(np.abs(obs[i]).max(), 1e-300) for i, s in enumerate(names)}
+    w = np.array([np.broadcast_to(np.asarray(weights.get(s, 1), dtype=float), t_obs.shape)
+                  for s in names])
+    if bounds is None:
+        bounds = [(0, 10 * model.rates[k] if model.rates[k] > 0 else np.inf) for k in idx]
+    lower, upper = (np.array(b, dtype=float) for b in zip(*bounds))
+
+    if isinstance(warm_start, OptimizeResult):
+        warm_start = warm_start.x
+    if warm_start is None and n_starts == 1:
+        warm_start = model.rates[idx]
+    rng = np.random.default_rng(seed)
+    starts = _starts(warm_start, lower, upper, n_starts, rng)
+
+    residuals = _Residuals(model, t0, t_obs, obs_idx, obs, w,
+                           np.asarray(inits, dtype=float), idx, method, rtol, atol)
+    if max_workers == 1 or 1 == len(starts):
+        fits = [_fit_start(residuals, x0, (lower, upper), jac, options) for x0 in starts]
+    else:
+        with ProcessPoolExecutor(max_workers=max_workers) as pool:
+            fits = list(pool.map(_fit_start, [residuals] * len(starts), starts,
+                                 [(lower, upper)] * len(starts), [jac] * len(starts),
+                                 [options] * len(starts)))
+
+    best = min(fits, key=lambda f: f.cost)
+    rates = residuals.rates(best.x)
+    return OptimizeResult(x=best.x, fit=[model.params[k] for k in idx], rates=rates,
+                          model=model.with_rates(rates), cost=best.cost,
+                          success=best.success, message=best.message, starts=fits,
+                          nfev=sum(f.nfev for f in fits), njev=sum(f.njev for f in fits),
+                          nsolve=sum(f.nsolve for f in fits),
+                          wall_time=time.perf_counter() - wall)
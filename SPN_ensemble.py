@@ -0,0 +1,149 @@
+import numpy as np
+from scipy.optimize import OptimizeResult
+
+from SPN_functions import compile_SPN, daily_t_eval
+
+
+# ----- batched ensemble integrator -----
+
+# solve_SPN integrates one run at a time with solve_ivp.  here all runs
+# are integrated together: the state is an (n_species, n_runs) array and
+# the compiled flux is evaluated for every run at once, with a separate
+# step size and error control for each run (Dormand-Prince 5(4), the
+# same pair as RK45).  steps are shortened to land exactly on t_eval,
+# so only the requested output grid is stored.
+
+# key function:
+#     solve_SPN_batch(G, params, inits, t0=0, t1=365, t_eval=None)
+#     returns result with t (n_times,) and y (n_runs, n_species, n_times)
+
+_A = [[],
+      [1/5],
+      [3/40, 9/40],
+      [44/45, -56/15, 32/9],
+      [19372/6561, -25360/2187, 64448/6561, -212/729],
+      [9017/3168, -355/33, 46732/5247, 49/176, -5103/18656],
+      [35/384, 0, 500/1113, 125/192, -2187/6784, 11/84]]
+
+# error estimate: difference between the 5th and 4th order weights
+_E = [-71/57600, 0, 71/16695, -71/1920, 17253/339200, -22/525, 1/40]
+
+
+def _rms(v):
+    return np.sqrt(np.mean(v**2, axis=0))
+
+
+def _initial_step(rhs, x, f, rates, rtol, atol):
+    # vectorized version of the starting step choice in solve_ivp
+    scale = atol + rtol * np.abs(x)
+    d0 = _rms(x / scale)
+    d1 = _rms(f / scale)
+    h0 = np.where((d0 < 1e-5) | (d1 < 1e-5), 1e-6, 0.01 * d0 / np.maximum(d1, 1e-300))
+    f1 = rhs(x + h0 * f, rates)
+    d2 = _rms((f1 - f) / scale) / h0
+    d = np.maximum(d1, d2)
+    h1 = np.where(d <= 1e-15, np.maximum(1e-6, h0 * 1e-3), (0.01 / np.maximum(d, 1e-300))**0.2)
+    return np.minimum(100 * h0, h1)
+
+
+def solve_SPN_batch(G, params=None, inits=None, t0=0, t1=365, t_eval=None,
+                    rtol=1e-6, atol=1e-9, max_steps=100000):
+    # INPUT: graph G or CompiledSPN
+    #        params (n_runs, n_params), ordered as model.params; default
+    #               the rates in G.  a single row is used for every run
+    #        inits (n_runs, n_species); a single row is used for every run
+    #        t_eval output times, default every day from t0 to t1
+    # OUTPUT: OptimizeResult with t, y (n_runs, n_species, n_times),
+    #         and per run success, nfev, nsteps, nrejected
+    #         (failed runs have nan after the failure)
+    model = compile_SPN(G)
+    n_s = len(model.species)
+    n_p = len(model.rates)
+
+    if params is None:
+        params = model.rates
+    params = np.atleast_2d(np.asarray(params, dtype=float))
+    inits = np.atleast_2d(np.asarray(inits, dtype=float))
+    if params.shape[1] != n_p:
+        raise ValueError(f"Expected {n_p} params {model.params}, got {params.shape[1]}")
+    if inits.shape[1] != n_s:
+        raise ValueError(f"Expected {n_s} initial values {model.species}, got {inits.shape[1]}")
+    n_runs = max(len(params), len(inits))
+    rates = np.array(np.broadcast_to(params, (n_runs, n_p)).T)
+    x = np.array(np.broadcast_to(inits, (n_runs, n_s)).T)
+
+    if t_eval is None:
+        t_eval = daily_t_eval(t0, t1)
+    t_eval = np.asarray(t_eval, dtype=float)
+    n_eval = len(t_eval)
+
+    N = model.N
+    flux = model.flux
+    def rhs(x, rates):
+        return N @ flux(x, rates)
+
+    y = np.full((n_runs, n_s, n_eval), np.nan)
+    k0 = np.searchsorted(t_eval, t0, side='right')
+    y[:, :, :k0] = x.T[:, :, None]
+
+    t = np.full(n_runs, float(t0))
+    idx = np.full(n_runs, k0)
+    success = np.ones(n_runs, dtype=bool)
+    nfev = np.full(n_runs, 2)
+    nsteps = np.zeros(n_runs, dtype=int)
+    nrejected = np.zeros(n_runs, dtype=int)
+
+    f = rhs(x, rates)
+    h = _initial_step(rhs, x, f, rates, rtol, atol)
+
+    active = idx < n_eval
+    for _ in range(max_steps):
+        a = np.flatnonzero(active)
+        if 0 == len(a):
+            break
+        xa, ra, ta = x[:, a], rates[:, a], t[a]
+        target = t_eval[idx[a]]
+        clipped = h[a] >= target - ta
+        ha = np.where(clipped, target - ta, h[a])
+
+        K = [f[:, a]]
+        for i in range(1, 7):
+            dx = sum(c * k for c, k in zip(_A[i], K) if c)
+            K.append(rhs(xa + ha * dx, ra))
+        # stage 7 is evaluated at the new point (first same as last)
+        x_new = xa + ha * sum(c * k for c, k in zip(_A[6], K) if c)
+        err = ha * sum(c * k for c, k in zip(_E, K) if c)
+        scale = atol + rtol * np.maximum(np.abs(xa), np.abs(x_new))
+        en = _rms(err / scale)
+        nfev[a] += 6
+
+        ok = en <= 1
+        with np.errstate(divide='ignore', invalid='ignore'):
+            factor = 0.9 * en**-0.2
+        factor = np.where(ok, np.minimum(10, np.nan_to_num(factor, nan=10, posinf=10)),
+                          np.clip(np.nan_to_num(factor, nan=0.2), 0.2, 1))
+        h_new = ha * factor
+        h[a] = np.where(ok & clipped, np.maximum(h_new, h[a]), h_new)
+
+        acc = a[ok]
+        nsteps[acc] += 1
+        nrejected[a[~ok]] += 1
+        x[:, acc] = x_new[:, ok]
+        f[:, acc] = K[6][:, ok]
+        t[acc] = np.where(clipped[ok], target[ok], ta[ok] + ha[ok])
+
+        hit = ok & clipped
+        runs = a[hit]
+        y[runs, :, idx[runs]] = x_new[:, hit].T
+        idx[runs] += 1
+
+        # runs whose step size has collapsed have failed
+        dead = a[h[a] < 1e-12 * np.maximum(1, np.abs(ta))]
+        success[dead] = False
+        idx[dead] = n_eval
+        active = idx < n_eval
+    else:
+        success[active] = False
+
+    return OptimizeResult(t=t_eval, y=y, success=success,
+                          nfev=nfev, nsteps=nsteps, nrejected=nrejected)
@@ -0,0 +1,166 @@
+import numpy as np
+from scipy.linalg import null_space
+from scipy.optimize import OptimizeResult
+
+from SPN_functions import compile_SPN, infected_species, sink_species
+
+
+# ----- equilibria and R0 without time integration -----
+
+# equilibria solve N @ flux(x) = 0 by Newton iteration with the exact
+# Jacobian, together with the conservation laws L @ x = L @ inits (rows of
+# L span the left null space of N, e.g. S + I + R + D = 1), so the
+# solution lies in the same population as inits.  the combined system has
+# more equations than unknowns, each Newton step is a least squares solve.
+
+# R0 comes from the next-generation matrix (van den Driessche and
+# Watmough 2002): infection transactions are those that increase the
+# total infected, like infect; at the disease-free equilibrium
+#     F = d(new infections)/dx,  V = -d(other flows)/dx
+# over the infected species, and R0 is the spectral radius of F V^-1.
+
+# sink species (never consumed, like D) do not affect any rate, and how
+# much ends up in them depends on the path taken, so they are held at
+# their values in inits.  note that in G_SIRDS deaths drain S + I + R
+# while I > 0, so for delta > 0 the only equilibria are disease-free and
+# endemic_equilibrium reports success False; with delta = 0 (or without
+# deaths) it is the SIRS state
+
+# key functions:
+#     disease_free_equilibrium(G, inits, params=None)
+#     endemic_equilibrium(G, inits, params=None)
+#     return results with x and success
+
+#     R0(G, inits, params=None)
+#     basic reproduction number at the disease-free equilibrium of inits
+
+def _dense_N(model):
+    return model.N.toarray() if hasattr(model.N, 'toarray') else np.asarray(model.N)
+
+
+def conservation_laws(G):
+    # OUTPUT: (n_laws, n_species) array L with L @ N = 0
+    model = compile_SPN(G)
+    L = null_space(_dense_N(model).T).T
+    L[np.abs(L) < 1e-12] = 0
+    return L
+
+
+def _infected(model, infected):
+    if infected is None:
+        infected = infected_species(model)
+    if not infected:
+        raise ValueError(f"No infected species found in {model.species}, pass infected")
+    return np.array([model.species.index(s) for s in infected])
+
+
+def infection_transactions(model, infected):
+    # OUTPUT: boolean mask of the transactions that increase total infected
+    return _dense_N(model)[infected].sum(axis=0) > 0
+
+
+def newton_SPN(G, x0, params=None, fixed=(), tol=1e-12, max_iter=50):
+    # INPUT: starting state x0, which also fixes the conservation totals
+    #        fixed species indices held at their values in x0 (sink
+    #        species always are)
+    # OUTPUT: OptimizeResult with x, success, nit, and the residual
+    #         (max abs rate) at x
+    model = compile_SPN(G)
+    rates = model.rates if params is None else np.asarray(params, dtype=float)
+    f = model.rate_fun(rates)
+    x = np.array(x0, dtype=float)
+    L = conservation_laws(model)
+    totals = L @ x
+    fixed = sorted(set(fixed) | {model.species.index(s) for s in sink_species(model)})
+    E = np.eye(len(x))[fixed]
+    held = x[fixed]
+    for nit in range(1, max_iter + 1):
+        F = np.concatenate((f(0, x), L @ x - totals, E @ x - held))
+        J = np.vstack((model.jac(x, rates), L, E))
+        dx = np.linalg.lstsq(J, -F, rcond=None)[0]
+        x += dx
+        if np.abs(dx).max() <= tol * max(1, np.abs(x).max()):
+            break
+    residual = np.abs(f(0, x)).max()
+    return OptimizeResult(x=x, success=bool(residual < np.sqrt(tol)), nit=nit,
+                          residual=residual)
+
+
+def _susceptibles(model, infected):
+    # for each infected species, the species its infection transactions
+    # consume (other than infected ones), e.g. I -> S
+    N = _dense_N(model)
+    inputs = np.asarray(model.inputs)
+    source = {}
+    for j in np.flatnonzero(infection_transactions(model, infected)):
+        gained = [i for i in infected if N[i, j] > 0]
+        consumed = [i for i in np.flatnonzero(inputs[j]) if i not in infected]
+        for i in gained:
+            source.setdefault(i, consumed[0] if consumed else None)
+    return source
+
+
+def disease_free_equilibrium(G, inits, params=None, infected=None):
+    # INPUT: inits sets the population; infected species default
+    #        infected_species(G)
+    # OUTPUT: OptimizeResult with x (infected at zero), success, nit
+    model = compile_SPN(G)
+    infected = _infected(model, infected)
+    # analytic guess: the infected go back to their susceptibles
+    x = np.array(inits, dtype=float)
+    for i, s in _susceptibles(model, infected).items():
+        if s is not None:
+            x[s] += x[i]
+            x[i] = 0
+    return newton_SPN(model, x, params, fixed=infected)
+
+
+def next_generation_matrix(G, x, params=None, infected=None):
+    # INPUT: state x, normally disease free
+    # OUTPUT: K = F V^-1 over the infected species
+    model = compile_SPN(G)
+    rates = model.rates if params is None else np.asarray(params, dtype=float)
+    infected = _infected(model, infected)
+    mask = infection_transactions(model, infected)
+    F = model.jac(x, rates * mask)[np.ix_(infected, infected)]
+    V = -model.jac(x, rates * ~mask)[np.ix_(infected, infected)]
+    return F @ np.linalg.inv(V)
+
+
+def R0(G, inits, params=None, infected=None):
+    dfe = disease_free_equilibrium(G, inits, params, infected)
+    K = next_generation_matrix(G, dfe.x, params, infected)
+    return float(np.abs(np.linalg.eigvals(K)).max())
+
+
+def endemic_equilibrium(G, inits, params=None, infected=None, tol=1e-12):
+    # OUTPUT: OptimizeResult with x, success, nit, R0; success is False
+    #         if R0 <= 1 or Newton ends at a disease-free or negative state
+    model = compile_SPN(G)
+    infected_idx = _infected(model, infected)
+    dfe = disease_free_equilibrium(model, inits, params, infected)
+    r0 = float(np.abs(np.linalg.eigvals(
+        next_generation_matrix(model, dfe.x, params, infected))).max())
+    if r0 <= 1:
+        return OptimizeResult(x=dfe.x, success=False, nit=0, R0=r0,
+                              message="R0 <= 1, no endemic equilibrium")
+
+    # analytic guess: infection balances removal when the susceptibles
+    # are cut to 1/R0 of the disease-free state; the rest is infected
+    x = np.array(dfe.x)
+    for i, s in _susceptibles(model, infected_idx).items():
+        if s is not None:
+            x[i] += x[s] * (1 - 1 / r0)
+            x[s] /= r0
+    res = newton_SPN(model, x, params, tol=tol)
+    res.R0 = r0
+    scale = max(1, np.abs(res.x).max())
+    if res.success and (res.x < -np.sqrt(tol) * scale).any():
+        res.success, res.message = False, "Newton converged to a negative state"
+    elif res.success and res.x[infected_idx].sum() <= np.sqrt(tol) * scale:
+        res.success, res.message = False, "Newton converged to a disease-free state"
+    elif not res.success:
+        res.message = "Newton did not converge"
+    else:
+        res.message = "endemic equilibrium found"
+    return res
@@ -1,119 +1,73 @@
-import networkx as nx
-import matplotlib.pyplot as plt
 import copy
-from scipy.integrate import solve_ivp
+import hashlib
+import threading
+import time
+from collections import Counter, OrderedDict
+import numpy as np
+from scipy.integrate import BDF, DOP853, LSODA, RK23, RK45, Radau, solve_ivp
+from scipy.optimize import OptimizeResult, brentq
+from scipy.sparse import csr_matrix
 
 
-# ----- draw SPN graphs -----
+# ----- numerics core -----
 
-def draw_SPN(G, t_disp='rate', t_label=True):
-    # INPUT: model graph G; attribute t_disp
-    # default: displays rate in transaction boxes
-    #          can change by altering t_disp
-    
-    # OUTPUT: shows figure, returns nothing
-    
-    plt.figure(figsize=G.graph.get('figsize', (12,8)) )
-    plt.axis('equal')
-    
-    pos = G.graph['pos']
-    
-    # Split nodes by type
-    species_nodes = [n for n, attr in G.nodes(data=True) if attr.get('type') == 'species']
-    transaction_nodes = [n for n, attr in G.nodes(data=True) if attr.get('type') == 'transaction']
-    
-    # Draw nodes on top
-    nx.draw_networkx_nodes(G, pos, nodelist=species_nodes, node_color='lightblue', node_shape='o', node_size=1800, edgecolors='black')
-    nx.draw_networkx_nodes(G, pos, nodelist=transaction_nodes, node_color='lightgreen', node_shape='s', node_size=1600)
-
-    # Use node size to determine reasonable label offset
-    label_offset = G.graph.get('label_offset', 0.1)
-
-    # Draw labels for species nodes (default position)
-    species_labels = {n: n for n in species_nodes}
-    nx.draw_networkx_labels(G, pos, labels=species_labels, font_size=16)
-
-    # Draw weight and label for transaction nodes
-    for n in transaction_nodes:
-        node_data = G.nodes[n]
-        x, y = pos[n]
-    
-        # Weight inside the node
-        if 'latex' == t_disp:
-            weight = '$'+node_data.get(t_disp, None)+'$'
-        else:
-            weight = node_data.get(t_disp, None)
-            
-        if weight is not None:
-            plt.text(x, y,      # Same coordinates as node center
-                f"{weight}", 
-                fontsize=14, 
-                ha='center', 
-                va='center', 
-                color='black', 
-                zorder=3)       # Ensure it's above edges
-
-    # Label below the node
-        if t_label:
-            plt.text(x, y - label_offset,    # Slightly below node
-                     n, fontsize=14, ha='center', 
-                     va='top', color='black',zorder=3)
-
-
-    # === Draw edges with curvature ===
-    for u, v, k in G.edges(keys=True):
-        rad = G.graph.get('edge_curvatures', {}).get((u, v, k), 0.0)  # default: straight
-        nx.draw_networkx_edges(
-            G,
-            pos,
-            edgelist=[(u, v)],
-            connectionstyle=f"arc3,rad={rad}",
-            arrowstyle='-|>',
-            arrowsize=20,
-            edge_color='black',
-            width=2,
-            min_source_margin=27,
-            min_target_margin=23
-        )
-
-    #plt.title("title")
-    plt.axis('off')
-    plt.show()
+# this module only imports NumPy and SciPy, so worker processes that
+# compile and solve start quickly.  drawing, plotting and the LaTeX
+# images and PDF are in SPN_plotting, which imports matplotlib and
+# networkx; its functions can still be imported from here, e.g.
+#     from SPN_functions import draw_SPN, proportions
+# and SPN_plotting is then loaded on first use (see the end of this file)
 
 
 # ----- rate equation in latex and code -----
 
 # key functions:
-#     pdf_rate_eqs(G, filename=False, symbol=True)
-#     saves PDF of rate equations using LaTeX
-    
-#     jupyter_rate_eqs(G, symbol=True)
-#     displays LaTeX rate equations in Jupyter Notebook
+#     latex_code(G, symbol=True)
+#     returns LaTeX align* block of the rate equations (pdf_rate_eqs and
+#     jupyter_rate_eqs in SPN_plotting typeset it)
     
 #     python_rate_fun(G, var_names=False)
-#     returns code for rate equations using given rates
+#     returns code for rate equations using given rates,
+#     or taking rates as a vector (see param_names) if var_names
+    
+#     compile_SPN(G, cache=True)
+#     compiles graph to arrays; .rate_fun() gives a vectorized rate function
+#     (cached by structural_hash, see model_cache.stats()); the result is
+#     frozen, use .with_rates(beta=0.3) for variants, and can be passed to
+#     the functions here in place of the graph
+
+# all of these take a graph G or a CompiledSPN (see below) in its place;
+# a graph is compiled (once, through the cache) and read from the arrays.
+# the generated code and LaTeX need mass-action models, so raise
+# ValueError for a StratifiedSPN
 
 def transactions(G):
+    if isinstance(G, CompiledSPN):
+        return list(G.transactions)
     return [n for n, attr in G.nodes(data=True) if attr.get('type') == 'transaction']
 
 def species(G):
+    if isinstance(G, CompiledSPN):
+        return list(G.species)
     return [n for n, attr in G.nodes(data=True) if attr.get('type') == 'species']
 
 def species_rate_from_transaction(G, spec, tran, symbol=False, rem_zero=False):
-    n = G.number_of_edges(tran, spec)
-    ms = {}
-    specs = species(G)
-    for s in specs:
-        ms[s] = G.number_of_edges(s, tran)
-    multiple = n - ms[spec]
+    model = compile_SPN(G)
+    if not model.mass_action:
+        # e.g. StratifiedSPN, whose infection terms mix over the contact
+        # matrix and are not a product of the transaction's inputs
+        raise ValueError(f"{model!r} is not mass action, so its rate equations can't be "
+                         f"written term by term; use stratify_SPN for a graph with one "
+                         f"transaction per pair of groups")
+    i = model.species.index(spec)
+    j = model.transactions.index(tran)
+    multiple = int(model.outputs[j, i] - model.inputs[j, i])
     if symbol:
-        rate = G.nodes[tran]['latex']
+        rate = model.latex[j]
     else:
-        rate = G.nodes[tran]['rate']
-    if rem_zero:
-        for s in specs:
-            if 0 == ms[s]:
-                del ms[s]
+        rate = float(model.rates[j])
+    ms = {s: int(m) for s, m in zip(model.species, model.inputs[j])
+          if m or not rem_zero}
     ans = [multiple, rate, ms]
     return ans
 
@@ -128,6 +82,7 @@ def pm_str(n):
 
 
 def latex_species_rate(G, spec, symbol=True, align=True):
+    G = compile_SPN(G)
     ans = r'\frac{d'+spec+'}{dt}'
     if align:
         ans += "&="
@@ -161,27 +116,8 @@ def latex_species_rate(G, spec, symbol=True, align=True):
     return ans
 
 
-def latex_image_spec(G, spec, symbol=True):
-    #plt.figure(figsize=(6,3))
-    plt.axis("off")
-    code = "$"+latex_species_rate(G, spec, symbol, align=False)+"$"
-    plt.text(0.1, 0.5, code, ha='left', va='center', fontsize=14)
-    plt.tight_layout()
-    plt.show()
-
-
-def latex_image(G, symbol=True):
-    plt.axis("off")
-    code = ''
-    for s in species(G):
-        code += '$'+latex_species_rate(G, s, symbol, align=False)+'$ \n'
-    
-    plt.text(0.1, 0.5, code, ha='left', va='center', fontsize=14)
-    plt.tight_layout()
-    plt.show()
-    
-
 def latex_code(G, symbol=True):
+    G = compile_SPN(G)
     code = r'\begin{align*} '
     for s in species(G):
         code += latex_species_rate(G, s, symbol, align=True)
@@ -189,51 +125,32 @@ def latex_code(G, symbol=True):
     return code
 
 
-def pdf_rate_eqs(G, filename=False, symbol=True):
-    code = r"""
-    \documentclass{article}
-    \usepackage{amsmath}
-
-    \begin{document}
-
-    """ + latex_code(G, symbol) + r"""
-    \end{document}
-    """
-    if False==filename:
-        filename = "equations.tex"
-        
-    # Write to file
-    with open(filename, "w") as f:
-        f.write(code)
-
-    # Compile
-    subprocess.run(["pdflatex", "equations.tex"])
-
-
-def jupyter_rate_eqs(G, symbol=True):
-    from IPython.display import display, Math
-    #display(Math(latex_code(G, symbol)))
-    for s in species(G):
-        display(Math('$'+latex_species_rate(G, s, symbol, align=False)+'$'))
-
+def param_names(G):
+    # returns names of the rates, in transaction order: the 'var'
+    # attribute of each transaction, or its name if it has none
+    if isinstance(G, CompiledSPN):
+        return list(G.params)
+    return [G.nodes[t].get('var', t) for t in transactions(G)]
 
 
 def python_species_rate(G, spec, var_names=False):
-    # idea: if var is false, hard code rates.
-    #       if true, use variable names (not coded!!)
-    if var_names:
-        raise ValueError("Var names implement not coded")
+    # if var_names is false, hard code rates.
+    # if true, use variable names from param_names
+    G = compile_SPN(G)
     ans = spec+'prime = '
-    for t in transactions(G):
+    for t, var in zip(G.transactions, G.params):
         l = species_rate_from_transaction(G, spec, t, symbol=False, rem_zero=True)
         n_m = l[0]
         if 0 != n_m:
-            term = f"+ {l[0]} * {l[1]} "
+            if var_names:
+                term = f"+ {l[0]} * {var} "
+            else:
+                term = f"+ {l[0]} * {l[1]} "
             for sp,m in l[2].items():
                 if 1==m:
                     term += f"* {sp} "
                 else:
-                    term += f"* pow({sp},m) "
+                    term += f"* pow({sp},{m}) "
             ans += term
     return ans
 
@@ -260,8 +177,15 @@ def python_rate_code(G, var_names=False):
     #if 'name' not in G.graph:
     #    raise ValueError("Graph needs a name")
     #code = f"def {G.name}_model(t, x0):\n"
-    code = "def ratefun(t, x0):\n"
+    # with var_names, the function takes the rates as a vector ordered
+    # as param_names(G): ratefun(t, x0, params)
+    G = compile_SPN(G)
     fs = "    "
+    if var_names:
+        code = "def ratefun(t, x0, params):\n"
+        code += fs + ", ".join(param_names(G)) + ", = params\n"
+    else:
+        code = "def ratefun(t, x0):\n"
     code += fs + species_with_commas(G) + " = x0\n"
     for s in species(G):
         code += fs + python_species_rate(G, s, var_names) + "\n"
@@ -274,9 +198,269 @@ def python_rate_fun(G, var_names=False):
     return sandbox['ratefun']
 
 
+# ----- compiled rate functions -----
+
+# the functions above write out one line of Python per species, so the
+# same flux (e.g. beta*S*I) is recomputed for every species it touches.
+# here we compile the graph once into arrays:
+#     inputs[j, i]   number of edges species i -> transaction j
+#     outputs[j, i]  number of edges transaction j -> species i
+#     N = (outputs - inputs).T   stoichiometry matrix (species x transactions)
+#     reactants[j]   species indices feeding transaction j, repeated by
+#                    multiplicity and padded with n_species (a constant 1)
+# so each rate evaluation computes every flux once and returns N @ flux
+
+class CompiledSPN:
+    # frozen once built: species, transactions etc. are tuples and the
+    # arrays are read-only.  with_rates gives a variant with other rates
+    # that shares everything else, instead of copying the graph
+    __slots__ = ('name', 'key', 'species', 'transactions', 'params', 'latex',
+                 'inputs', 'outputs', 'N', 'reactants', 'rates', 'jac_sparsity',
+                 '_slots', '_jac_keys', '_jac_target', '_jac_j', '_jac_k',
+                 '_jac_coef', '_frozen')
+
+    # flux is plain mass action on the species, as the stochastic
+    # simulations assume (not so for StratifiedSPN)
+    mass_action = True
+
+    def __init__(self, G, key=None):
+        self.name = getattr(G, 'name', '')
+        self.key = structural_hash(G) if key is None else key
+        self.species = tuple(species(G))
+        self.transactions = tuple(transactions(G))
+        self.params = tuple(param_names(G))
+        self.latex = tuple(G.nodes[t].get('latex', p)
+                           for t, p in zip(self.transactions, self.params))
+        n_s = len(self.species)
+        n_t = len(self.transactions)
+        s_index = {s: i for i, s in enumerate(self.species)}
+        t_index = {t: j for j, t in enumerate(self.transactions)}
+
+        inputs = np.zeros((n_t, n_s), dtype=int)
+        outputs = np.zeros((n_t, n_s), dtype=int)
+        for u, v in G.edges():
+            if u in s_index and v in t_index:
+                inputs[t_index[v], s_index[u]] += 1
+            elif u in t_index and v in s_index:
+                outputs[t_index[u], s_index[v]] += 1
+        self.inputs = inputs
+        self.outputs = outputs
+        self.N = (outputs - inputs).T.astype(float)
+
+        order = max(inputs.sum(axis=1).max() if n_t else 0, 1)
+        reactants = np.full((n_t, order), n_s, dtype=int)
+        for j in range(n_t):
+            r = np.repeat(np.arange(n_s), inputs[j])
+            reactants[j, :len(r)] = r
+        self.reactants = reactants
+        # one index array per reactant slot, cheaper than prod(axis=1)
+        self._slots = [reactants[:, k] for k in range(order)]
+
+        # Jacobian: d flux_j / d x_c, for c = reactants[j, k], is rate j times
+        # the product of the other slots of j, and lands in column c of every
+        # row i with N[i, j] != 0.  fix the sparsity pattern and where each
+        # (i, j, k) term goes in it once, here
+        ti, tj, tk = [], [], []
+        for j, k in zip(*np.nonzero(reactants < n_s)):
+            for i in np.flatnonzero(self.N[:, j]):
+                ti.append(i)
+                tj.append(j)
+                tk.append(k)
+        ti, tj, tk = np.array(ti, dtype=int), np.array(tj, dtype=int), np.array(tk, dtype=int)
+        keys = ti * n_s + reactants[tj, tk]
+        self._jac_keys, self._jac_target = np.unique(keys, return_inverse=True)
+        self._jac_j, self._jac_k = tj, tk
+        self._jac_coef = self.N[ti, tj]
+        rows = self._jac_keys // n_s
+        self.jac_sparsity = csr_matrix(
+            (np.ones(len(rows)), self._jac_keys % n_s,
+             np.searchsorted(rows, np.arange(n_s + 1))),
+            shape=(n_s, n_s))
+
+        self.rates = np.array([G.nodes[t]['rate'] for t in self.transactions], dtype=float)
+
+        for a in (self.inputs, self.outputs, self.N, self.reactants, self.rates):
+            a.flags.writeable = False
+        self._frozen = True
+
+    def __setattr__(self, name, value):
+        if getattr(self, '_frozen', False):
+            raise AttributeError(f"CompiledSPN is frozen, can't set {name}; use with_rates")
+        object.__setattr__(self, name, value)
+
+    def __getstate__(self):
+        return {k: getattr(self, k) for cls in type(self).__mro__
+                for k in getattr(cls, '__slots__', ()) if hasattr(self, k)}
+
+    def __setstate__(self, state):
+        for k, v in state.items():
+            object.__setattr__(self, k, v)
+
+    def __repr__(self):
+        return (f"<CompiledSPN {self.name or ''} {len(self.species)} species, "
+                f"{len(self.transactions)} transactions>")
+
+    def flux(self, x, rates=None):
+        # INPUT: state x, shape (n_species,) or (n_species, n_runs)
+        # OUTPUT: mass-action flux of every transaction, same trailing shape
+        if rates is None:
+            rates = self.rates
+        x = np.asarray(x, dtype=float)
+        xe = np.concatenate((x, np.ones((1,) + x.shape[1:])))
+        if x.ndim > np.ndim(rates):
+            rates = np.asarray(rates)[:, None]
+        slots = self._slots
+        f = rates * xe[slots[0]]
+        for k in slots[1:]:
+            f = f * xe[k]
+        return f
+
+    def rate_fun(self, rates=None):
+        # OUTPUT: function ratefun(t, x0), as python_rate_fun, returning N @ flux
+        # (flux inlined for the 1-d states solve_ivp passes)
+        N = self.N
+        if rates is None:
+            rates = self.rates
+        one = np.ones(1)
+        first, rest = self._slots[0], self._slots[1:]
+        def ratefun(t, x0):
+            xe = np.concatenate((x0, one))
+            f = rates * xe[first]
+            for k in rest:
+                f = f * xe[k]
+            return N @ f
+        return ratefun
+
+    def jac(self, x, rates=None, sparse=False):
+        # INPUT: state x, shape (n_species,)
+        # OUTPUT: exact Jacobian of N @ flux at x, dense array or
+        #         csr_matrix with pattern jac_sparsity
+        if rates is None:
+            rates = self.rates
+        xe = np.concatenate((x, [1.0]))
+        vals = [xe[k] for k in self._slots]
+        others = np.ones((len(rates), len(vals)))
+        for k in range(len(vals)):
+            for l in range(len(vals)):
+                if l != k:
+                    others[:, k] *= vals[l]
+        w = rates[self._jac_j] * others[self._jac_j, self._jac_k]
+        data = np.bincount(self._jac_target, weights=self._jac_coef * w,
+                           minlength=len(self._jac_keys))
+        n = len(self.species)
+        if sparse:
+            pattern = self.jac_sparsity
+            return csr_matrix((data, pattern.indices, pattern.indptr), shape=(n, n))
+        J = np.zeros(n * n)
+        J[self._jac_keys] = data
+        return J.reshape(n, n)
+
+    def with_rates(self, rates=None, **overrides):
+        # INPUT: rates vector ordered as params, and/or single rates by
+        #        param or transaction name, e.g. with_rates(beta=0.3)
+        # OUTPUT: copy sharing all arrays except the rates
+        rates = np.array(self.rates if rates is None else rates, dtype=float)
+        if rates.shape != self.rates.shape:
+            raise ValueError(f"Expected {len(self.rates)} rates {self.params}, got {rates.shape}")
+        for name, value in overrides.items():
+            if name in self.params:
+                rates[self.params.index(name)] = value
+            elif name in self.transactions:
+                rates[self.transactions.index(name)] = value
+            else:
+                raise ValueError(f"No rate called {name}, expected one of {self.params}")
+        rates.flags.writeable = False
+        new = copy.copy(self)
+        object.__setattr__(new, 'rates', rates)
+        return new
+
+    def jac_fun(self, rates=None, sparse=False):
+        # OUTPUT: function jac(t, x0), for the jac argument of solve_ivp
+        def jac(t, x0):
+            return self.jac(x0, rates, sparse)
+        return jac
+
+
+# ----- cache of compiled models -----
+
+# compiling only depends on the structure of the graph, so compiled models
+# are cached by a hash of species, transactions (with their var names) and
+# edge multiplicities.  rates, pos, edge_curvatures etc. are not part of
+# the key; a cache hit gets the current rates of G via with_rates, and
+# the current latex labels and name of G
+
+def structural_hash(G):
+    if isinstance(G, CompiledSPN):
+        return G.key
+    edges = Counter((repr(u), repr(v)) for u, v in G.edges())
+    key = repr((species(G),
+                [(t, G.nodes[t].get('var', t)) for t in transactions(G)],
+                sorted(edges.items())))
+    return hashlib.sha1(key.encode()).hexdigest()
+
+
+class ModelCache:
+    # least recently used cache of CompiledSPN, at most maxsize entries
+    def __init__(self, maxsize=128):
+        self.maxsize = maxsize
+        self.models = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+
+    def get(self, G):
+        key = structural_hash(G)
+        with self._lock:
+            model = self.models.get(key)
+            if model is not None:
+                self.models.move_to_end(key)
+                self.hits += 1
+        if model is None:
+            model = CompiledSPN(G, key)
+            with self._lock:
+                self.misses += 1
+                self.models[key] = model
+                while len(self.models) > self.maxsize:
+                    self.models.popitem(last=False)
+                    self.evictions += 1
+            return model
+        new = model.with_rates([G.nodes[t]['rate'] for t in model.transactions])
+        latex = tuple(G.nodes[t].get('latex', p)
+                      for t, p in zip(model.transactions, model.params))
+        if latex != new.latex:
+            object.__setattr__(new, 'latex', latex)
+        name = getattr(G, 'name', '')
+        if name != new.name:
+            object.__setattr__(new, 'name', name)
+        return new
+
+    def stats(self):
+        return {'hits': self.hits, 'misses': self.misses,
+                'evictions': self.evictions,
+                'size': len(self.models), 'maxsize': self.maxsize}
+
+    def clear(self):
+        with self._lock:
+            self.models.clear()
+            self.hits = self.misses = self.evictions = 0
+
+
+model_cache = ModelCache()
+
+
+def compile_SPN(G, cache=True):
+    if isinstance(G, CompiledSPN):
+        return G
+    if cache:
+        return model_cache.get(G)
+    return CompiledSPN(G)
+
+
 # ----- deep copying graphs -----
 
 # needed because we store data in attributes
+# (to run with other rates, compile_SPN(G).with_rates(...) is far cheaper)
 
 def deep_copy_graph(G):
     # Create the same type of graph (MultiDiGraph, DiGraph, etc.)
@@ -301,58 +485,299 @@ def deep_copy_graph(G):
 
 
 
-# ----- solve rate equations for graph -----
+# ----- solver statistics -----
 
-def solve_SPN(G, inits, t0=0, t1=365):
-    rate_fun = python_rate_fun(G)
-    return solve_ivp(rate_fun, t_span=(t0, t1), 
-                     y0=inits, rtol=1e-9, atol=1e-12)
+# with stats=True (in solve_SPN, proportions, Sim.solve) or while any hook
+# is registered, the solver is run through a subclass that records every
+# accepted step, and a SolveStats record is attached to the result as
+# sim.stats and passed to each hook.  otherwise nothing extra is done.
 
+# rejected steps are only known for the explicit Runge-Kutta methods,
+# from the number of rate function calls per step; else they are None
 
-# ----- plot proportions -----
+stats_hooks = []
 
-def proportions(G, inits, t0=0, t1=365, fs=(10,5), title="", col_alpha=False, cols=None, alphas=None, key_loc=(0.06, 0.7)):
-    sim = solve_SPN(G, inits, t0, t1)
-    
-    specs = species(G)
-    n = len(specs)
-    
-    backsums = [sim.y[n-1]]
-    for i in range(n-1):
-        backsums.append(backsums[-1]+sim.y[n-2-i])
-    
-    plt.figure(figsize=fs) # default (width, height) = (6.4, 4.8)
-    
-    if col_alpha:
-        for i in range(n-1):
-            plt.fill_between(sim.t, backsums[n-2-i], backsums[n-1-i], label=specs[i], color=cols[specs[i]], alpha=alphas[specs[i]])
-        
-        plt.fill_between(sim.t, 0, backsums[0], label=specs[n-1], color=cols[specs[n-1]], alpha=alphas[specs[n-1]])
-        
-        #raise ValueError("need to get colours working")
-        # plt.fill_between(ts, SIRDS_backsums[2], SIRDS_backsums[3], color='black', label='S', alpha=0.1)
-    else:
-        for i in range(n-1):
-            plt.fill_between(sim.t, backsums[n-i-1], backsums[n-i-1], label=specs[i])
-        
-        plt.fill_between(sim.t, 0, backsums[0], label=specs[n-1])
-        
-    for i in range(n):
-        plt.plot(sim.t, backsums[i], color='black')
-        
-    plt.xlabel('time (days)')
-    plt.ylabel('population proportions')
-    plt.legend(loc=key_loc)
-    plt.title(title)
-    plt.show()
+def add_stats_hook(fun):
+    # fun(stats) is called with the SolveStats of every solve
+    stats_hooks.append(fun)
+
+def remove_stats_hook(fun):
+    stats_hooks.remove(fun)
+
+def emit_stats(stats):
+    for fun in list(stats_hooks):
+        fun(stats)
 
-    return None
 
+class SolveStats:
+    __slots__ = ('source', 'method', 'n_species', 'nfev', 'njev', 'nlu',
+                 'n_accepted', 'n_rejected', 'h_min', 'h_max',
+                 'compile_time', 'solve_time', 'plot_time', 'wall_time')
 
+    def __init__(self, source, method):
+        for k in self.__slots__:
+            setattr(self, k, None)
+        self.source = source
+        self.method = method
 
+    def as_dict(self):
+        return {k: getattr(self, k) for k in self.__slots__}
 
+    def __repr__(self):
+        return "SolveStats(" + ", ".join(f"{k}={v!r}" for k, v in self.as_dict().items()) + ")"
 
 
+def _counting_solver(method, steps):
+    # subclass of the solve_ivp method that appends (h, attempts) to
+    # steps for each accepted step
+    base = solvers[method] if isinstance(method, str) else method
+    stages = getattr(base, 'n_stages', None)
+    class Counting(base):
+        def _step_impl(self):
+            t, nfev = self.t, self.nfev
+            success, message = super()._step_impl()
+            if success:
+                steps.append((abs(self.t - t), (self.nfev - nfev) // stages if stages else None))
+            return success, message
+    return Counting
 
 
+def solve_ivp_stats(fun, t_span, y0, method='RK45', source='solve_ivp', **options):
+    # solve_ivp, returning the result with a SolveStats as sim.stats
+    # (not emitted: the caller adds its own phases and calls emit_stats)
+    steps = []
+    stats = SolveStats(source, method if isinstance(method, str) else method.__name__)
+    start = time.perf_counter()
+    sim = solve_ivp(fun, t_span, y0, method=_counting_solver(method, steps), **options)
+    stats.solve_time = time.perf_counter() - start
+    stats.n_species = len(sim.y)
+    stats.nfev, stats.njev, stats.nlu = sim.nfev, sim.njev, sim.nlu
+    stats.n_accepted = len(steps)
+    if steps:
+        hs = [h for h, _ in steps]
+        stats.h_min, stats.h_max = float(min(hs)), float(max(hs))
+        if steps[0][1] is not None:
+            stats.n_rejected = sum(a - 1 for _, a in steps)
+    sim.stats = stats
+    return sim
 
+
+# ----- solve rate equations for graph -----
+
+# implicit methods use the compiled Jacobian; use them (e.g. 'BDF') for
+# stiff models, like fast infection with slow waning over long times
+
+implicit_methods = ('BDF', 'Radau', 'LSODA')
+
+# the solve_ivp methods by name, for stepping a solver by hand
+solvers = {'RK23': RK23, 'RK45': RK45, 'DOP853': DOP853,
+           'Radau': Radau, 'BDF': BDF, 'LSODA': LSODA}
+
+def daily_t_eval(t0, t1):
+    # default output times: every day from t0, ending at t1 even when
+    # t1 - t0 is not a whole number of days
+    t = np.arange(t0, t1 + 1e-9, 1.0)
+    if t[-1] < t1 - 1e-9:
+        t = np.append(t, t1)
+    return np.minimum(t, t1)
+
+# results can be kept on disk between sessions, see SPN_results.py.
+# enable_result_cache() there sets result_cache, after which solves
+# without stats (solve_SPN, proportions, Sim.solve) go through it
+
+result_cache = None
+
+def cached_solve(parts, solve):
+    # INPUT: parts that determine the result (model key, rates, inits,
+    #        times, solver settings), solve() computing it
+    if result_cache is None:
+        return solve()
+    return result_cache.get_or_solve(result_cache.key(*parts), solve)
+
+# G can be a graph or a CompiledSPN; pass a compiled model and params
+# (ordered as model.params) to run many rates without recompiling.
+# with reduce, the system is first reduced by its sinks and conservation
+# laws (see SPN_reduce.py) and y rebuilt in full.  that pays for implicit
+# methods, whose cost grows with the size of the Jacobian (about half the
+# time for BDF on SIRDS stratified over 128 groups or more), but not for
+# explicit ones on these small models, so the default reduce=None only
+# reduces for implicit methods
+
+def solve_SPN(G, inits, t0=0, t1=365, method='RK45', sparse=False, rtol=1e-9, atol=1e-12, params=None, t_eval=None, stats=False, reduce=None):
+    record = stats or stats_hooks
+    if record:
+        start = time.perf_counter()
+    model = compile_SPN(G)
+    if params is not None:
+        params = np.asarray(params, dtype=float)
+        if params.shape != model.rates.shape:
+            raise ValueError(f"Expected {len(model.rates)} params {model.params}, got {params.shape}")
+    if reduce is None:
+        reduce = method in implicit_methods
+    reduced = None
+    if reduce:
+        # SPN_reduce imports this module
+        from SPN_reduce import integrate_reduced, reduce_SPN
+        reduced = reduce_SPN(model)
+        if len(reduced.state) == len(model.species):
+            reduced = None
+    if reduced is not None:
+        def integrate(integrator):
+            return integrate_reduced(reduced, inits, t0, t1, method, sparse, rtol, atol,
+                                     params, t_eval, integrator)
+    else:
+        options = {}
+        if method in implicit_methods:
+            # LSODA only takes dense Jacobians
+            options['jac'] = model.jac_fun(params, sparse=sparse and method != 'LSODA')
+        def integrate(integrator):
+            return integrator(model.rate_fun(params), (t0, t1), inits, method=method,
+                              rtol=rtol, atol=atol, t_eval=t_eval, **options)
+    if not record:
+        rates = model.rates if params is None else params
+        return cached_solve((model.key, rates, inits, t0, t1, t_eval, method, sparse,
+                             rtol, atol, reduced is not None), lambda: integrate(solve_ivp))
+    compiled = time.perf_counter()
+    sim = integrate(lambda fun, t_span, y0, **options:
+                    solve_ivp_stats(fun, t_span, y0, source='solve_SPN', **options))
+    sim.stats.compile_time = compiled - start
+    sim.stats.wall_time = time.perf_counter() - start
+    emit_stats(sim.stats)
+    return sim
+
+
+# ----- summary solves -----
+
+# for sweeps that only need a few numbers per run.  the solver is stepped
+# by hand and nothing is stored; after each step we check for events:
+#     peak       total infected stops growing (time found by root finding
+#                on the step's interpolant)
+#     extinct    total infected falls below threshold while decreasing
+#     equilibrium, after the peak, no non-sink species changes faster
+#                than eq_tol per unit time
+# the last two stop the solve.  at equilibrium, sink species (never
+# consumed, like D) carry on at their current rate, so final is still an
+# estimate at t1.
+
+# key function:
+#     summary_SPN(G, inits, t0=0, t1=365, infected=None, threshold=1e-8)
+#     returns result with status, final, peak, peak_time, extinction_time
+
+def infected_species(G):
+    # default infected species: those both consumed and produced by a
+    # transaction, like I in infect
+    model = compile_SPN(G)
+    return [s for i, s in enumerate(model.species)
+            if ((model.inputs[:, i] > 0) & (model.outputs[:, i] > 0)).any()]
+
+def sink_species(G):
+    # species that no transaction consumes, like D
+    model = compile_SPN(G)
+    return [s for i, s in enumerate(model.species) if not model.inputs[:, i].any()]
+
+
+def summarise_ivp(fun, t_span, y0, infected, sinks=(), method='RK45',
+                  threshold=1e-8, eq_tol=1e-10, args=(), **options):
+    # INPUT: rate function fun(t, y, *args), indices of infected and of
+    #        sink species, options for the solver (rtol, atol, jac)
+    # OUTPUT: OptimizeResult with status ('t1', 'extinct', 'equilibrium'
+    #         or 'failed'), t_stop, y_stop, final, peak, peak_time,
+    #         extinction_time, nfev, n_steps
+    if args:
+        f = lambda t, y: fun(t, y, *args)
+    else:
+        f = fun
+    t0, t1 = t_span
+    solver = solvers[method](f, t0, np.asarray(y0, dtype=float), t1, **options)
+    infected = np.asarray(infected, dtype=int)
+    keep = np.ones(len(solver.y), dtype=bool)
+    keep[list(sinks)] = False
+
+    def total(y):
+        return y[infected].sum()
+
+    def rate(t, y):
+        return np.asarray(f(t, y), dtype=float)
+
+    dy = rate(t0, solver.y)
+    peak, peak_time = total(solver.y), t0
+    extinction_time = None
+    past_peak = False
+    status = 't1'
+    n_steps = 0
+    while 'running' == solver.status:
+        t_old = solver.t
+        dI_old = total(dy)
+        solver.step()
+        if 'failed' == solver.status:
+            status = 'failed'
+            break
+        n_steps += 1
+        t, y = solver.t, solver.y
+        # the Runge-Kutta solvers already have the rate at the new point
+        dy = solver.f if hasattr(solver, 'f') else rate(t, y)
+        I, dI = total(y), total(dy)
+        if dI_old > 0 and dI <= 0:
+            dense = solver.dense_output()
+            tp = brentq(lambda s: total(rate(s, dense(s))), t_old, t) if dI < 0 else t
+            if total(dense(tp)) > peak:
+                peak, peak_time = total(dense(tp)), tp
+            past_peak = True
+        elif I > peak:
+            peak, peak_time = I, t
+        if I < threshold and dI < 0:
+            dense = solver.dense_output()
+            if total(dense(t_old)) > threshold:
+                extinction_time = brentq(lambda s: total(dense(s)) - threshold, t_old, t)
+            else:
+                extinction_time = t
+            status = 'extinct'
+            break
+        if past_peak and np.abs(dy[keep]).max() < eq_tol:
+            status = 'equilibrium'
+            break
+
+    final = np.array(solver.y)
+    if 'equilibrium' == status:
+        final[~keep] += dy[~keep] * (t1 - solver.t)
+    return OptimizeResult(status=status, t_stop=solver.t, y_stop=np.array(solver.y),
+                          final=final, peak=peak, peak_time=peak_time,
+                          extinction_time=extinction_time, nfev=solver.nfev,
+                          n_steps=n_steps, success=status != 'failed')
+
+
+def summary_SPN(G, inits, t0=0, t1=365, infected=None, threshold=1e-8, eq_tol=1e-10,
+                method='RK45', sparse=False, rtol=1e-9, atol=1e-12, params=None):
+    # as summarise_ivp, for a graph or CompiledSPN; infected is a list of
+    # species names, default infected_species(G).  final is also given
+    # by name, e.g. res.final_by_species['D'] for finalD
+    model = compile_SPN(G)
+    if infected is None:
+        infected = infected_species(model)
+    if not infected:
+        raise ValueError(f"No infected species found in {model.species}, pass infected")
+    if params is not None:
+        params = np.asarray(params, dtype=float)
+    options = {}
+    if method in implicit_methods:
+        options['jac'] = model.jac_fun(params, sparse=sparse and method != 'LSODA')
+    res = summarise_ivp(model.rate_fun(params), (t0, t1), inits,
+                        [model.species.index(s) for s in infected],
+                        [model.species.index(s) for s in sink_species(model)],
+                        method, threshold, eq_tol, rtol=rtol, atol=atol, **options)
+    res.final_by_species = dict(zip(model.species, res.final))
+    return res
+
+
+# ----- plotting and LaTeX, loaded on demand -----
+
+plotting_names = ('draw_SPN', 'draw_SPN_files', 'latex_image_spec', 'latex_image',
+                  'pdf_rate_eqs', 'jupyter_rate_eqs', 'decimate', 'proportions',
+                  'StreamingQuantiles', 'proportion_bands')
+
+
+def __getattr__(name):
+    if name in plotting_names:
+        import SPN_plotting
+        return getattr(SPN_plotting, name)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
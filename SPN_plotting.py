@@ -0,0 +1,419 @@
+import os
+import subprocess
+import time
+import warnings
+from functools import lru_cache
+
+import networkx as nx
+import matplotlib.pyplot as plt
+from matplotlib.collections import PathCollection
+from matplotlib.figure import Figure
+from matplotlib.textpath import TextPath
+from matplotlib.transforms import Affine2D
+import numpy as np
+
+from SPN_functions import (SolveStats, emit_stats, latex_code, latex_species_rate,
+                           solve_SPN, species, stats_hooks)
+
+
+# ----- plotting and LaTeX layer -----
+
+# everything that needs matplotlib, networkx drawing or a LaTeX install,
+# kept out of SPN_functions so that importing the numerics does not
+# import them.  the functions here are also found as SPN_functions.name
+
+# ----- draw SPN graphs -----
+
+# edges are drawn by networkx, with one draw_networkx_edges call per
+# curvature rather than one per edge.  the arrows are patches placed at
+# draw time, so they follow any later resizing or change of limits.
+# labels inside and below transaction nodes are one PathCollection of
+# text paths, the most recently used of which are cached
+
+def _draw_edges(ax, G, pos, curvatures):
+    groups = {}
+    for e in G.edges(keys=True):
+        groups.setdefault(curvatures.get(e, 0.0), []).append(e)
+    for rad, edges in groups.items():
+        nx.draw_networkx_edges(G, pos, edgelist=edges, ax=ax, arrows=True,
+                               connectionstyle=f"arc3,rad={rad}",
+                               arrowstyle='-|>', arrowsize=20, edge_color='black', width=2,
+                               min_source_margin=27, min_target_margin=23)
+
+
+@lru_cache(maxsize=256)
+def _text_path(label, fontsize, va):
+    # label centred on (0, 0) (va='center') or hanging below it (va='top'),
+    # from the extent of its vertices (Path.get_extents is slow on glyphs)
+    path = TextPath((0, 0), label, size=fontsize)
+    box = TextPath((0, 0), 'Mg', size=fontsize).vertices[:, 1]
+    x = path.vertices[:, 0]
+    dy = -(box.min() + box.max()) / 2 if 'center' == va else -box.max()
+    return path.transformed(Affine2D().translate(-(x.min() + x.max()) / 2, dy))
+
+
+def _text_collection(ax, xy, labels, fontsize=14, va='center'):
+    paths = [_text_path(label, fontsize, va) for label in labels]
+    if paths:
+        ax.add_collection(PathCollection(paths, offsets=list(xy), offset_transform=ax.transData,
+                                         transform=Affine2D().scale(ax.figure.dpi / 72),
+                                         facecolors='black', edgecolors='none', zorder=3,
+                                         clip_on=False),
+                          autolim=False)
+
+
+def draw_SPN(G, t_disp='rate', t_label=True, filename=None, ax=None):
+    # INPUT: model graph G; attribute t_disp
+    # default: displays rate in transaction boxes
+    #          can change by altering t_disp
+    #        filename: save the figure there (format from the extension)
+    #                  instead of showing it, without pyplot, so this
+    #                  works headless and in batch jobs
+    #        ax: draw on this axis instead of a new figure
+
+    # OUTPUT: shows figure, returns nothing; with filename or ax, returns
+    #         the figure
+
+    show = ax is None and filename is None
+    if ax is None:
+        if filename is None:
+            fig = plt.figure(figsize=G.graph.get('figsize', (12,8)) )
+        else:
+            fig = Figure(figsize=G.graph.get('figsize', (12,8)))
+        ax = fig.add_subplot()
+    fig = ax.figure
+    ax.axis('equal')
+    
+    pos = G.graph['pos']
+    
+    # Split nodes by type
+    species_nodes = [n for n, attr in G.nodes(data=True) if attr.get('type') == 'species']
+    transaction_nodes = [n for n, attr in G.nodes(data=True) if attr.get('type') == 'transaction']
+    
+    # Draw nodes on top
+    nx.draw_networkx_nodes(G, pos, nodelist=species_nodes, node_color='lightblue', node_shape='o', node_size=1800, edgecolors='black', ax=ax)
+    nx.draw_networkx_nodes(G, pos, nodelist=transaction_nodes, node_color='lightgreen', node_shape='s', node_size=1600, ax=ax)
+
+    # Use node size to determine reasonable label offset
+    label_offset = G.graph.get('label_offset', 0.1)
+
+    # Draw labels for species nodes (default position)
+    species_labels = {n: n for n in species_nodes}
+    nx.draw_networkx_labels(G, pos, labels=species_labels, font_size=16, ax=ax)
+
+    # Weight inside each transaction node, name below it
+    weights = [(n, G.nodes[n].get(t_disp, None)) for n in transaction_nodes]
+    weights = [(n, '$'+w+'$' if 'latex' == t_disp else f"{w}") for n, w in weights if w is not None]
+    _text_collection(ax, [pos[n] for n, _ in weights], [w for _, w in weights])
+    if t_label:
+        _text_collection(ax, [(pos[n][0], pos[n][1] - label_offset) for n in transaction_nodes],
+                         transaction_nodes, va='top')
+
+    # === Draw edges with curvature ===
+    _draw_edges(ax, G, pos, G.graph.get('edge_curvatures', {}))
+
+    #plt.title("title")
+    ax.axis('off')
+    if filename is not None:
+        fig.savefig(filename)
+        return fig
+    if show:
+        plt.show()
+    else:
+        return fig
+
+
+def draw_SPN_files(graphs, directory='.', ext='svg', **kwargs):
+    # saves draw_SPN of each graph (with pos) as directory/<name>.<ext>
+    # OUTPUT: list of filenames
+    filenames = []
+    for G in graphs:
+        if 'pos' in G.graph:
+            filename = os.path.join(directory, f"{G.name}.{ext}")
+            draw_SPN(G, filename=filename, **kwargs)
+            filenames.append(filename)
+    return filenames
+
+
+# ----- rate equations as images and PDF -----
+
+# key functions:
+#     pdf_rate_eqs(G, filename=False, symbol=True)
+#     saves PDF of rate equations using LaTeX
+    
+#     jupyter_rate_eqs(G, symbol=True)
+#     displays LaTeX rate equations in Jupyter Notebook
+
+def latex_image_spec(G, spec, symbol=True):
+    #plt.figure(figsize=(6,3))
+    plt.axis("off")
+    code = "$"+latex_species_rate(G, spec, symbol, align=False)+"$"
+    plt.text(0.1, 0.5, code, ha='left', va='center', fontsize=14)
+    plt.tight_layout()
+    plt.show()
+
+
+def latex_image(G, symbol=True):
+    plt.axis("off")
+    code = ''
+    for s in species(G):
+        code += '$'+latex_species_rate(G, s, symbol, align=False)+'$ \n'
+    
+    plt.text(0.1, 0.5, code, ha='left', va='center', fontsize=14)
+    plt.tight_layout()
+    plt.show()
+    
+
+
+def pdf_rate_eqs(G, filename=False, symbol=True):
+    code = r"""
+    \documentclass{article}
+    \usepackage{amsmath}
+
+    \begin{document}
+
+    """ + latex_code(G, symbol) + r"""
+    \end{document}
+    """
+    if False==filename:
+        filename = "equations.tex"
+        
+    # Write to file
+    with open(filename, "w") as f:
+        f.write(code)
+
+    # Compile
+    subprocess.run(["pdflatex", filename])
+
+
+def jupyter_rate_eqs(G, symbol=True):
+    from IPython.display import display, Math
+    #display(Math(latex_code(G, symbol)))
+    for s in species(G):
+        display(Math('$'+latex_species_rate(G, s, symbol, align=False)+'$'))
+
+
+# ----- plot proportions -----
+
+# pass sim (anything with .t and .y, e.g. from solve_SPN_stream) to plot
+# an existing result instead of solving.  the solve goes through
+# solve_SPN, which records it as usual; the plot is recorded separately,
+# as SolveStats with source 'proportions', plot_time and wall_time (solve
+# included), returned with stats=True
+
+# long results are cut down to about one point per horizontal pixel
+# before plotting: in each of n_points equal time buckets, the first,
+# last, lowest and highest point of every stacked curve is kept, so the
+# plot looks the same.  with filename, the figure is saved there without
+# pyplot (as in draw_SPN), for rendering many figures off-screen
+
+def decimate(t, Y, n_points):
+    # INPUT: times t, rows Y (n_rows, n_times), number of buckets
+    # OUTPUT: sorted indices of the points to keep
+    t = np.asarray(t)
+    if len(t) <= 4 * n_points:
+        return np.arange(len(t))
+    b = np.minimum(((t - t[0]) / (t[-1] - t[0]) * n_points).astype(int), n_points - 1)
+    starts = np.flatnonzero(np.diff(b, prepend=-1))
+    counts = np.diff(np.append(starts, len(t)))
+    keep = np.zeros(len(t), dtype=bool)
+    keep[starts] = True
+    keep[starts + counts - 1] = True
+    for reduce in (np.minimum, np.maximum):
+        extreme = np.repeat(reduce.reduceat(Y, starts, axis=1), counts, axis=1)
+        keep |= (Y == extreme).any(axis=0)
+    return np.flatnonzero(keep)
+
+
+def _figure(fs, filename, ax):
+    # new pyplot figure, or a bare Figure when saving to file
+    if ax is None:
+        fig = plt.figure(figsize=fs) if filename is None else Figure(figsize=fs)
+        ax = fig.add_subplot()
+    return ax.figure, ax
+
+
+def proportions(G, inits, t0=0, t1=365, fs=(10,5), title="", col_alpha=False, cols=None, alphas=None, key_loc=(0.06, 0.7), sim=None, stats=False, filename=None, ax=None, n_points=None):
+    record = stats or stats_hooks
+    if record:
+        start = time.perf_counter()
+    if sim is None:
+        sim = solve_SPN(G, inits, t0=t0, t1=t1, stats=stats)
+    if record:
+        plot_start = time.perf_counter()
+    
+    specs = species(G)
+    n = len(specs)
+    show = ax is None and filename is None
+    fig, ax = _figure(fs, filename, ax) # default (width, height) = (6.4, 4.8)
+
+    # backsums[i] = y[n-1] + ... + y[n-1-i]
+    backsums = np.cumsum(np.asarray(sim.y)[::-1], axis=0)
+    ts = np.asarray(sim.t)
+    if n_points is None:
+        n_points = int(fig.get_figwidth() * fig.dpi)
+    keep = decimate(ts, backsums, n_points)
+    ts, backsums = ts[keep], backsums[:, keep]
+    
+    if col_alpha:
+        for i in range(n-1):
+            ax.fill_between(ts, backsums[n-2-i], backsums[n-1-i], label=specs[i], color=cols[specs[i]], alpha=alphas[specs[i]])
+        
+        ax.fill_between(ts, 0, backsums[0], label=specs[n-1], color=cols[specs[n-1]], alpha=alphas[specs[n-1]])
+        
+        #raise ValueError("need to get colours working")
+        # plt.fill_between(ts, SIRDS_backsums[2], SIRDS_backsums[3], color='black', label='S', alpha=0.1)
+    else:
+        for i in range(n-1):
+            ax.fill_between(ts, backsums[n-i-1], backsums[n-i-1], label=specs[i])
+        
+        ax.fill_between(ts, 0, backsums[0], label=specs[n-1])
+        
+    ax.plot(ts, backsums.T, color='black')
+        
+    ax.set_xlabel('time (days)')
+    ax.set_ylabel('population proportions')
+    ax.legend(loc=key_loc)
+    ax.set_title(title)
+    if filename is not None:
+        fig.savefig(filename)
+    elif show:
+        plt.show()
+
+    if record:
+        solved = getattr(sim, 'stats', None)
+        st = SolveStats('proportions', solved and solved.method)
+        st.n_species = n
+        st.plot_time = time.perf_counter() - plot_start
+        st.wall_time = time.perf_counter() - start
+        emit_stats(st)
+        if stats:
+            return st
+    return None
+
+
+# ----- ensemble quantile bands -----
+
+# for many runs of one model (sweeps, tau_leap_SPN replicates), the median
+# of each species over time with bands between quantiles.  the runs can
+# come as one (n_runs, n_species, n_times) array or as an iterable of
+# such chunks, read one at a time.  the first exact_runs runs are kept,
+# and their quantiles are exact.  beyond that they go into a histogram of
+# bins per species and time, so memory does not grow with the number of
+# runs.  each histogram spans the range of its own cell in the kept runs
+# (or the given limits), so a compartment of a few hundred in a population
+# of a million is binned as finely as the population itself, and the
+# quantiles are kept within the smallest and largest value seen.  later
+# values outside that range count in the end bins, with a warning
+
+class StreamingQuantiles:
+    def __init__(self, shape, limits=None, bins=1000, exact_runs=1000):
+        # INPUT: shape of one run, e.g. (n_species, n_times)
+        #        limits (lo, hi) for every cell, or None for the range of
+        #               each cell in the kept runs
+        #        exact_runs number of runs kept for exact quantiles
+        self.shape = tuple(shape)
+        self.limits = limits
+        self.bins = bins
+        self.exact_runs = exact_runs
+        size = int(np.prod(self.shape))
+        self.runs = []
+        self.counts = None
+        self.lo = self.width = None
+        self.min = np.full(size, np.nan)
+        self.max = np.full(size, np.nan)
+        self.n = 0
+        self.outside = 0
+
+    def update(self, chunk):
+        # chunk (k,) + shape; nan values (failed runs) are left out
+        chunk = np.asarray(chunk, dtype=float).reshape(-1, len(self.min))
+        self.n += len(chunk)
+        self.min = np.fmin(self.min, np.fmin.reduce(chunk, axis=0))
+        self.max = np.fmax(self.max, np.fmax.reduce(chunk, axis=0))
+        if self.counts is not None:
+            self._count(chunk)
+            return
+        self.runs.append(chunk)
+        if self.n > self.exact_runs:
+            kept = np.concatenate(self.runs)
+            self.runs = None
+            if self.limits is None:
+                self.lo, hi = np.nan_to_num(self.min), np.nan_to_num(self.max)
+            else:
+                self.lo = np.full(len(self.min), float(self.limits[0]))
+                hi = np.full(len(self.min), float(self.limits[1]))
+            self.width = np.where(hi > self.lo, hi - self.lo, 1.0)
+            self.counts = np.zeros((len(self.min), self.bins), dtype=np.uint32)
+            self._count(kept)
+
+    def _count(self, chunk):
+        ok = ~np.isnan(chunk)
+        scaled = (chunk - self.lo) / self.width
+        self.outside += int(((scaled[ok] < 0) | (scaled[ok] > 1)).sum())
+        b = np.clip(np.nan_to_num(scaled * self.bins).astype(int), 0, self.bins - 1)
+        cells = np.broadcast_to(np.arange(len(self.counts)), chunk.shape)
+        self.counts += np.bincount((cells * self.bins + b)[ok],
+                                   minlength=self.counts.size).reshape(self.counts.shape).astype(np.uint32)
+
+    def quantile(self, q):
+        if self.counts is None:
+            with warnings.catch_warnings():
+                # cells where every run failed
+                warnings.simplefilter('ignore', RuntimeWarning)
+                return np.nanquantile(np.concatenate(self.runs), q, axis=0).reshape(self.shape)
+        cdf = np.cumsum(self.counts, axis=1, dtype=np.int64)
+        target = q * cdf[:, -1]
+        b = np.argmax(cdf >= target[:, None], axis=1)
+        rows = np.arange(len(cdf))
+        below = np.where(b > 0, cdf[rows, np.maximum(b - 1, 0)], 0)
+        inside = self.counts[rows, b]
+        frac = np.where(inside > 0, (target - below) / np.maximum(inside, 1), 0.5)
+        out = np.clip(self.lo + (b + frac) * self.width / self.bins, self.min, self.max)
+        out[cdf[:, -1] == 0] = np.nan
+        return out.reshape(self.shape)
+
+
+def proportion_bands(G, t, runs, quantiles=(0.05, 0.25), limits=None, bins=1000,
+                     fs=(10,5), title="", cols=None, key_loc=(0.06, 0.7),
+                     filename=None, ax=None, exact_runs=1000):
+    # INPUT: graph G or CompiledSPN (for the species names), times t
+    #        runs (n_runs, n_species, len(t)) or an iterable of chunks
+    #        quantiles lower quantiles q, each giving a band q to 1 - q
+    #        limits range of the values for the histograms, e.g. (0, 1) for
+    #               proportions; default the range of each species and time
+    #        exact_runs runs kept for exact quantiles, see StreamingQuantiles
+    # OUTPUT: dict of the plotted median and quantiles, each
+    #         (n_species, len(t)); shows the figure, or saves to filename
+    specs = species(G)
+    if isinstance(runs, np.ndarray):
+        runs = [runs]
+    acc = StreamingQuantiles((len(specs), len(t)), limits, bins, exact_runs)
+    for chunk in runs:
+        acc.update(chunk)
+    if acc.n == 0:
+        raise ValueError("No runs given")
+    if acc.outside:
+        warnings.warn(f"{acc.outside} values outside the range of the first "
+                      f"{acc.exact_runs} runs (or limits) were counted at its ends; "
+                      f"pass limits, or a larger exact_runs")
+    levels = sorted({0.5} | set(quantiles) | {1 - q for q in quantiles})
+    qs = {q: acc.quantile(q) for q in levels}
+
+    show = ax is None and filename is None
+    fig, ax = _figure(fs, filename, ax)
+    for i, s in enumerate(specs):
+        colour = None if cols is None else cols[s]
+        line, = ax.plot(t, qs[0.5][i], color=colour, label=s)
+        for q in sorted(quantiles):
+            ax.fill_between(t, qs[q][i], qs[1 - q][i], color=line.get_color(),
+                            alpha=0.4 * (0.5 - abs(0.5 - q)) + 0.05, linewidth=0)
+    ax.set_xlabel('time (days)')
+    ax.set_ylabel('population proportions')
+    ax.legend(loc=key_loc)
+    ax.set_title(title)
+    if filename is not None:
+        fig.savefig(filename)
+    elif show:
+        plt.show()
+    return qs
@@ -0,0 +1,220 @@
+import threading
+from collections import OrderedDict
+
+import numpy as np
+from scipy.integrate import solve_ivp
+from scipy.sparse import csr_matrix
+
+from SPN_equilibrium import conservation_laws
+from SPN_functions import compile_SPN, implicit_methods
+
+
+# ----- model reduction before integration -----
+
+# two kinds of species need not be integrated:
+#  - sinks, whose column of the Jacobian is empty: no rate depends on
+#    them (D, or Dy and Do in G_SIRDS2).  their rate is a fixed
+#    combination of the fluxes, N[i] @ flux(x), so they follow from the
+#    rest of the trajectory by quadrature
+#  - one species per conservation law L @ x = L @ inits (rows of L span
+#    the left null space of N, e.g. S + I + R + D = 1), which is then
+#    total minus the others
+
+# L is brought to reduced row echelon form with the sinks ordered first,
+# so each law eliminates a sink where it can (D = 1 - S - I - R, exactly,
+# with no quadrature needed) and laws eliminating other species only
+# involve non-sinks.  what is left is integrated, with the Jacobian of
+# the reduced state, and the full trajectory rebuilt on the output times.
+# for G_SIRDS that is 3 species out of 4, for SIRDS stratified over n
+# groups 3n out of 4n, and the Jacobian (3n)^2 instead of (4n)^2.
+
+# quadrature of any remaining sinks uses the solver's dense output at
+# 5 Gauss points per output interval, so needs no extra right hand sides.
+
+# key functions:
+#     reduce_SPN(G)
+#     returns ReducedSPN with the integrated, eliminated and quadrature
+#     species; works on CompiledSPN and StratifiedSPN
+
+#     solve_reduced_SPN(G, inits, t0=0, t1=365)
+#     as solve_SPN, integrating the reduced system; y is the full state.
+#     solve_SPN does this itself for implicit methods (reduce=None)
+
+def _rref(A, order, tol=1e-10):
+    # INPUT: matrix A, order to try columns in
+    # OUTPUT: (R, pivots): rows of R span those of A, and R[:, pivots] = I
+    R = np.array(A, dtype=float)
+    pivots = []
+    row = 0
+    for c in order:
+        if row == len(R):
+            break
+        p = row + np.argmax(np.abs(R[row:, c]))
+        if abs(R[p, c]) < tol:
+            continue
+        R[[row, p]] = R[[p, row]]
+        R[row] /= R[row, c]
+        others = np.arange(len(R)) != row
+        R[others] -= np.outer(R[others, c], R[row])
+        pivots.append(c)
+        row += 1
+    R[np.abs(R) < tol] = 0
+    return R[:row], pivots
+
+
+class ReducedSPN:
+    def __init__(self, G):
+        model = compile_SPN(G)
+        self.model = model
+        n = len(model.species)
+        pattern = csr_matrix(model.jac_sparsity)
+        sinks = np.flatnonzero(np.bincount(pattern.indices, minlength=n) == 0)
+        is_sink = np.zeros(n, dtype=bool)
+        is_sink[sinks] = True
+        order = list(sinks) + [i for i in range(n) if not is_sink[i]]
+        self.laws, pivots = _rref(conservation_laws(model), order)
+        pivots = np.array(pivots, dtype=int)
+        # laws with a non-sink pivot have no sink terms (rref, sinks first)
+        self.law_sink = is_sink[pivots]
+        eliminated = np.zeros(n, dtype=bool)
+        eliminated[pivots] = True
+        # integrated: non-sinks not eliminated; quadrature: the other sinks
+        self.state = np.flatnonzero(~is_sink & ~eliminated)
+        self.quadrature = np.flatnonzero(is_sink & ~eliminated)
+        self.eliminated = pivots
+        # non-sink eliminated species: x[dep] = totals[law] - C @ x[state]
+        self._dep_rows = np.flatnonzero(~self.law_sink)
+        self._dep = pivots[self._dep_rows]
+        self._C = self.laws[np.ix_(self._dep_rows, self.state)]
+        N = model.N.toarray() if hasattr(model.N, 'toarray') else np.asarray(model.N)
+        self._N_quad = N[self.quadrature]
+
+    def __repr__(self):
+        species = self.model.species
+        return (f"<ReducedSPN {self.model.name or ''} integrating "
+                f"{[species[i] for i in self.state]} of {len(species)} species>")
+
+    def totals(self, inits):
+        return self.laws @ np.asarray(inits, dtype=float)
+
+    def expand(self, z, totals):
+        # INPUT: reduced states z, shape (n_state,) or (n_state, n_times)
+        # OUTPUT: full states with sinks set to 0 (they do not affect any
+        #         rate); finish() fills them in
+        z = np.asarray(z, dtype=float)
+        x = np.zeros((len(self.model.species),) + z.shape[1:])
+        x[self.state] = z
+        t = totals[self._dep_rows]
+        x[self._dep] = (t[:, None] if z.ndim > 1 else t) - self._C @ z
+        return x
+
+    def rate_fun(self, totals, rates=None):
+        # the model's own rate function on the full state, kept in one
+        # buffer whose sinks stay at 0, then the rows of the state
+        full = self.model.rate_fun(rates)
+        state, dep, C = self.state, self._dep, self._C
+        t_dep = totals[self._dep_rows]
+        x = np.zeros(len(self.model.species))
+        def ratefun(t, z):
+            x[state] = z
+            if len(dep):
+                x[dep] = t_dep - C @ z
+            return full(t, x)[state]
+        return ratefun
+
+    def jac_fun(self, totals, rates=None, sparse=False):
+        # J_red = J[state, state] - J[state, dep] @ C, from the model's
+        # own Jacobian (sparse if asked) on a buffer as rate_fun
+        jac, state, dep, C = self.model.jac, self.state, self._dep, self._C
+        t_dep = totals[self._dep_rows]
+        x = np.zeros(len(self.model.species))
+        def jacfun(t, z):
+            x[state] = z
+            if len(dep):
+                x[dep] = t_dep - C @ z
+            J = jac(x, rates, sparse)[state]
+            if sparse:
+                J = csr_matrix(J)
+                J_red = J[:, state]
+                return J_red - csr_matrix(J[:, dep] @ C) if len(dep) else J_red
+            return J[:, state] - J[:, dep] @ C if len(dep) else J[:, state]
+        return jacfun
+
+    def finish(self, x, t0, t, sol, totals, inits, rates=None):
+        # fills in the sinks of full states x at times t: quadrature from
+        # the dense output sol, then the laws with sink pivots
+        if len(self.quadrature):
+            if rates is None:
+                rates = self.model.rates
+            nodes, weights = np.polynomial.legendre.leggauss(5)
+            a, b = np.concatenate(([t0], t[:-1])), t
+            ts = (a + b)[:, None] / 2 + (b - a)[:, None] / 2 * nodes
+            xs = self.expand(sol(ts.ravel()), totals)
+            rate = (self._N_quad @ self.model.flux(xs, rates)).reshape(-1, *ts.shape)
+            steps = rate @ weights * (b - a) / 2
+            x[self.quadrature] = np.asarray(inits, dtype=float)[self.quadrature, None] \
+                + np.cumsum(steps, axis=1)
+        rows = np.flatnonzero(self.law_sink)
+        if len(rows):
+            L = self.laws[rows]
+            piv = self.eliminated[rows]
+            x[piv] = 0
+            x[piv] = totals[rows, None] - L @ x
+        return x
+
+
+# reductions of the most recently used models, at most reduced_maxsize,
+# as model_cache (StratifiedSPN keys include the contact matrix, so a
+# sweep over contact matrices would otherwise keep every one)
+reduced_maxsize = 128
+_reduced = OrderedDict()
+_reduced_lock = threading.Lock()
+
+
+def reduce_SPN(G):
+    model = compile_SPN(G)
+    with _reduced_lock:
+        reduced = _reduced.get(model.key)
+        if reduced is not None:
+            _reduced.move_to_end(model.key)
+            return reduced
+    reduced = ReducedSPN(model)
+    with _reduced_lock:
+        _reduced[model.key] = reduced
+        while len(_reduced) > reduced_maxsize:
+            _reduced.popitem(last=False)
+    return reduced
+
+
+def integrate_reduced(reduced, inits, t0, t1, method, sparse, rtol, atol, rates, t_eval,
+                      integrate=solve_ivp):
+    # INPUT: ReducedSPN, rates ordered as params (None for the model's),
+    #        integrate(fun, t_span, y0, **options) e.g. solve_ivp or
+    #        solve_ivp_stats
+    # OUTPUT: its result with y (n_species, n_times), the full state,
+    #         and reduced, the ReducedSPN integrated
+    if rates is None:
+        rates = reduced.model.rates
+    inits = np.asarray(inits, dtype=float)
+    totals = reduced.totals(inits)
+    options = {}
+    if method in implicit_methods:
+        options['jac'] = reduced.jac_fun(totals, rates, sparse=sparse and method != 'LSODA')
+    sim = integrate(reduced.rate_fun(totals, rates), (t0, t1), inits[reduced.state],
+                    method=method, rtol=rtol, atol=atol, t_eval=t_eval,
+                    dense_output=len(reduced.quadrature) > 0, **options)
+    x = reduced.expand(sim.y, totals)
+    sim.y = reduced.finish(x, t0, sim.t, sim.sol, totals, inits, rates)
+    sim.reduced = reduced
+    return sim
+
+
+def solve_reduced_SPN(G, inits, t0=0, t1=365, method='RK45', sparse=False, rtol=1e-9,
+                      atol=1e-12, params=None, t_eval=None):
+    # INPUT: as solve_SPN
+    # OUTPUT: solve_ivp result with y (n_species, n_times), the full state,
+    #         and reduced, the ReducedSPN integrated
+    model = compile_SPN(G)
+    rates = None if params is None else np.asarray(params, dtype=float)
+    return integrate_reduced(reduce_SPN(model), inits, t0, t1, method, sparse, rtol, atol,
+                             rates, t_eval)
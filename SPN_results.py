@@ -0,0 +1,170 @@
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import threading
+import time
+
+import numpy as np
+from scipy.optimize import OptimizeResult
+
+import SPN_functions
+
+
+# ----- on-disk result cache -----
+
+# a result is stored as a directory named by its key, holding t.npy,
+# y.npy (one contiguous row per species) and meta.json.  arrays are
+# loaded memory-mapped, so a hit only reads the parts that are used.
+
+# the key hashes everything the result depends on: structural hash of
+# the model, rates, inits, time span and t_eval, solver and tolerances.
+# entries are written to a temporary directory and renamed into place,
+# so several processes can share a cache; a lock file lets the first of
+# them solve while the others wait for its result instead of repeating
+# it.  when the cache is over max_bytes, least recently used entries go.
+
+# key functions:
+#     enable_result_cache(directory, max_bytes=2**30)
+#     solve_SPN, proportions and Sim.solve then use the cache
+
+#     disable_result_cache()
+
+class ResultCache:
+    def __init__(self, directory, max_bytes=2**30, wait=600):
+        # wait: seconds to wait for another process solving the same key,
+        #       after which its lock is taken to be stale
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.wait = wait
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+        os.makedirs(directory, exist_ok=True)
+
+    @staticmethod
+    def key(*parts):
+        h = hashlib.sha1()
+        for p in parts:
+            if isinstance(p, (np.ndarray, list, tuple)) and not isinstance(p, str):
+                a = np.asarray(p)
+                if a.dtype.kind in 'biuf':
+                    a = np.ascontiguousarray(a, dtype=float)
+                    h.update(repr(('array', a.shape)).encode() + a.tobytes())
+                    continue
+            h.update(repr(p).encode())
+            h.update(b'\0')
+        return h.hexdigest()
+
+    def _path(self, key):
+        return os.path.join(self.directory, key)
+
+    def get(self, key):
+        # OUTPUT: stored result with memory-mapped t and y, or None
+        path = self._path(key)
+        try:
+            with open(os.path.join(path, 'meta.json')) as f:
+                meta = json.load(f)
+            t = np.load(os.path.join(path, 't.npy'), mmap_mode='r')
+            y = np.load(os.path.join(path, 'y.npy'), mmap_mode='r')
+            os.utime(path)
+        except (OSError, ValueError):
+            return None
+        return OptimizeResult(t=t, y=y, cached=True, **meta)
+
+    def put(self, key, sim):
+        path = self._path(key)
+        if os.path.exists(path):
+            return
+        tmp = tempfile.mkdtemp(prefix='.tmp-', dir=self.directory)
+        try:
+            np.save(os.path.join(tmp, 't.npy'), np.ascontiguousarray(sim.t, dtype=float))
+            np.save(os.path.join(tmp, 'y.npy'), np.ascontiguousarray(sim.y, dtype=float))
+            meta = {k: sim.get(k) for k in ('success', 'status', 'message', 'nfev', 'njev', 'nlu')}
+            meta = {k: v.item() if isinstance(v, np.generic) else v for k, v in meta.items()}
+            with open(os.path.join(tmp, 'meta.json'), 'w') as f:
+                json.dump(meta, f)
+            os.rename(tmp, path)
+        except OSError:
+            # someone else stored it first
+            shutil.rmtree(tmp, ignore_errors=True)
+        self.evict()
+
+    def get_or_solve(self, key, solve):
+        sim = self.get(key)
+        if sim is not None:
+            with self._lock:
+                self.hits += 1
+            return sim
+        lock = self._path(key) + '.lock'
+        deadline = time.monotonic() + self.wait
+        while True:
+            try:
+                os.close(os.open(lock, os.O_CREAT | os.O_EXCL | os.O_WRONLY))
+                break
+            except FileExistsError:
+                # another process is solving it
+                time.sleep(0.05)
+                sim = self.get(key)
+                if sim is not None:
+                    with self._lock:
+                        self.hits += 1
+                    return sim
+                if time.monotonic() > deadline:
+                    lock = None
+                    break
+        try:
+            with self._lock:
+                self.misses += 1
+            sim = solve()
+            if sim.success:
+                self.put(key, sim)
+        finally:
+            if lock is not None:
+                os.remove(lock)
+        return sim
+
+    def entries(self):
+        # OUTPUT: list of (last used, bytes, key), oldest first
+        out = []
+        for entry in os.scandir(self.directory):
+            if not entry.is_dir() or entry.name.startswith('.'):
+                continue
+            try:
+                size = sum(f.stat().st_size for f in os.scandir(entry.path))
+                out.append((entry.stat().st_mtime, size, entry.name))
+            except OSError:
+                pass
+        return sorted(out)
+
+    def evict(self):
+        entries = self.entries()
+        total = sum(size for _, size, _ in entries)
+        for _, size, key in entries:
+            if total <= self.max_bytes:
+                break
+            shutil.rmtree(self._path(key), ignore_errors=True)
+            total -= size
+            with self._lock:
+                self.evictions += 1
+
+    def stats(self):
+        entries = self.entries()
+        return {'hits': self.hits, 'misses': self.misses, 'evictions': self.evictions,
+                'entries': len(entries), 'bytes': sum(size for _, size, _ in entries),
+                'max_bytes': self.max_bytes}
+
+    def clear(self):
+        for _, _, key in self.entries():
+            shutil.rmtree(self._path(key), ignore_errors=True)
+
+
+def enable_result_cache(directory, max_bytes=2**30):
+    SPN_functions.result_cache = ResultCache(directory, max_bytes)
+    return SPN_functions.result_cache
+
+
+def disable_result_cache():
+    SPN_functions.result_cache = None
@@ -0,0 +1,201 @@
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+from scipy.integrate import solve_ivp
+from scipy.optimize import OptimizeResult
+
+from SPN_functions import compile_SPN, daily_t_eval, implicit_methods
+
+
+# ----- scenario trees -----
+
+# a scenario is a schedule of rate changes, e.g. for interventions
+#     {'cut':        [(60, {'beta': 0.3})],
+#      'cut, relax': [(60, {'beta': 0.3}), (120, {'beta': 0.45})],
+#      'cut, wane':  [(60, {'beta': 0.3}), (120, {'omega': 0.01})],
+#      'none':       []}
+# each change holds from its time until the next one, on top of the
+# earlier ones (rates by param or transaction name, as with_rates).
+# scenarios with the same changes up to some time share the trajectory
+# up to then: the schedules are merged into a tree whose nodes are runs
+# of constant rates, each integrated once.  the state is stored at every
+# branch point, and children carry on from there, in parallel across a
+# process pool if max_workers is not 1.  integration always stops at a
+# rate change, as the rates are discontinuous there.
+
+# key functions:
+#     tree = ScenarioTree(G, inits, schedules, t0=0, t1=365)
+#     tree.solve(max_workers=1)
+#     returns result with t and y, a dict from scenario name to
+#     (n_species, n_times), and n_segments integrated
+
+#     tree.extend(t1)
+#     continues every scenario from its stored end state to a later t1
+
+#     extend_SPN(G, sim, t1)
+#     the same for a single solve_SPN result
+
+def _solve_segment(model, rates, x0, t_start, stops, t_eval, method, rtol, atol):
+    # integrates with constant rates from t_start through each of the
+    # sorted stops in turn, restarting at each
+    # OUTPUT: (states at the stops, outputs on t_eval in [t_start, stops[-1]])
+    options = {}
+    if method in implicit_methods:
+        options['jac'] = model.jac_fun(rates, sparse=False)
+    fun = model.rate_fun(rates)
+    states, ys = [], []
+    x, a = np.asarray(x0, dtype=float), t_start
+    for i, b in enumerate(stops):
+        last = i == len(stops) - 1
+        ts = t_eval[(t_eval >= a) & ((t_eval <= b) if last else (t_eval < b))]
+        if b > a:
+            sim = solve_ivp(fun, (a, b), x, method=method, rtol=rtol, atol=atol,
+                            t_eval=np.append(ts, b) if len(ts) == 0 or ts[-1] < b else ts,
+                            **options)
+            if not sim.success:
+                raise RuntimeError(f"Solve from t={a} stopped at t={sim.t[-1]}: {sim.message}")
+            ys.append(sim.y[:, :len(ts)])
+            x = sim.y[:, -1]
+        else:
+            ys.append(np.repeat(x[:, None], len(ts), axis=1))
+        states.append(x)
+        a = b
+    return states, np.hstack(ys) if ys else np.zeros((len(x0), 0))
+
+
+class _Node:
+    # a run of constant rates from start, until the last of its children
+    # start or, if any scenarios end here, until t1
+    __slots__ = ('start', 'rates', 'children', 'ends', 'x0', 'y', 'x1')
+
+    def __init__(self, start, rates):
+        self.start = start
+        self.rates = rates
+        self.children = {}
+        self.ends = []
+        self.x0 = None
+        self.y = None
+        self.x1 = None
+
+
+class ScenarioTree:
+    def __init__(self, G, inits, schedules, t0=0, t1=365, t_eval=None,
+                 method='RK45', rtol=1e-9, atol=1e-12):
+        # INPUT: graph G or CompiledSPN, inits at t0
+        #        schedules dict scenario name -> list of (time, {rate: value})
+        #        t_eval output times, default every day from t0 to t1
+        self.model = compile_SPN(G)
+        self.t0, self.t1 = t0, t1
+        if t_eval is None:
+            t_eval = daily_t_eval(t0, t1)
+        self.t_eval = np.asarray(t_eval, dtype=float)
+        self.method, self.rtol, self.atol = method, rtol, atol
+        self.root = _Node(t0, self.model.rates)
+        self.root.x0 = np.asarray(inits, dtype=float)
+        self.paths = {}
+        for name, schedule in schedules.items():
+            node, path = self.root, [self.root]
+            for t, overrides in sorted(schedule, key=lambda c: c[0]):
+                if not t0 < t < t1:
+                    raise ValueError(f"Change at t={t} in {name} is not inside ({t0}, {t1})")
+                key = (t, tuple(sorted(overrides.items())))
+                if key not in node.children:
+                    node.children[key] = _Node(t, self.model.with_rates(node.rates, **overrides).rates)
+                node = node.children[key]
+                path.append(node)
+            node.ends.append(name)
+            self.paths[name] = path
+
+    def _stops(self, node):
+        stops = {child.start for child in node.children.values()}
+        if node.ends:
+            stops.add(self.t1)
+        return sorted(stops)
+
+    def solve(self, max_workers=1):
+        # solves the nodes level by level, the children of every solved node
+        # being independent of each other
+        n_segments = 0
+        level = [self.root]
+        pool = None if max_workers == 1 else ProcessPoolExecutor(max_workers=max_workers)
+        try:
+            while level:
+                args = [(self.model, node.rates, node.x0, node.start, self._stops(node),
+                         self.t_eval, self.method, self.rtol, self.atol) for node in level]
+                if pool is None:
+                    results = [_solve_segment(*a) for a in args]
+                else:
+                    results = list(pool.map(_solve_segment, *zip(*args)))
+                next_level = []
+                for node, (states, y) in zip(level, results):
+                    at = dict(zip(self._stops(node), states))
+                    node.y = y
+                    node.x1 = at.get(self.t1)
+                    for child in node.children.values():
+                        child.x0 = at[child.start]
+                        next_level.append(child)
+                    n_segments += len(states)
+                level = next_level
+        finally:
+            if pool is not None:
+                pool.shutdown()
+        return self.result(n_segments)
+
+    def result(self, n_segments=None):
+        y = {}
+        for name, path in self.paths.items():
+            pieces = []
+            for node, after in zip(path, path[1:] + [None]):
+                # t_eval of this node's outputs start at node.start, and
+                # the next node takes over at its start
+                ts = self.t_eval[self.t_eval >= node.start]
+                n = len(ts) if after is None else np.searchsorted(ts, after.start)
+                pieces.append(node.y[:, :n])
+            y[name] = np.hstack(pieces)
+        return OptimizeResult(t=self.t_eval, y=y, n_segments=n_segments, success=True)
+
+    def extend(self, t1, t_eval=None):
+        # INPUT: later end time t1, and the extra output times after the
+        #        old t1 (default every day up to t1)
+        # OUTPUT: result as solve(), from the old t0 to the new t1
+        if t1 <= self.t1:
+            raise ValueError(f"Can only extend beyond t1={self.t1}")
+        if t_eval is None:
+            t_eval = daily_t_eval(self.t1, t1)[1:]
+        t_eval = np.asarray(t_eval, dtype=float)
+        n_segments = 0
+        for node in self._leaves():
+            states, y = _solve_segment(self.model, node.rates, node.x1, self.t1, [t1],
+                                       t_eval, self.method, self.rtol, self.atol)
+            node.y = np.hstack((node.y, y))
+            node.x1 = states[-1]
+            n_segments += 1
+        self.t_eval = np.concatenate((self.t_eval, t_eval))
+        self.t1 = t1
+        return self.result(n_segments)
+
+    def _leaves(self):
+        stack, leaves = [self.root], []
+        while stack:
+            node = stack.pop()
+            if node.ends:
+                leaves.append(node)
+            stack.extend(node.children.values())
+        return leaves
+
+
+def extend_SPN(G, sim, t1, t_eval=None, method='RK45', rtol=1e-9, atol=1e-12, params=None):
+    # INPUT: solve_SPN result sim, ending at sim.t[-1]; later end time t1
+    #        t_eval extra output times, default every day after sim.t[-1]
+    # OUTPUT: result with t and y covering both, continued from the last
+    #         stored state without solving the first part again
+    model = compile_SPN(G)
+    rates = model.rates if params is None else np.asarray(params, dtype=float)
+    t_end = float(sim.t[-1])
+    if t_eval is None:
+        t_eval = daily_t_eval(t_end, t1)[1:]
+    t_eval = np.asarray(t_eval, dtype=float)
+    states, y = _solve_segment(model, rates, sim.y[:, -1], t_end, [t1], t_eval,
+                               method, rtol, atol)
+    return OptimizeResult(t=np.concatenate((sim.t, t_eval)), y=np.hstack((sim.y, y)),
+                          success=True)
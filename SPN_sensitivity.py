@@ -0,0 +1,91 @@
+import numpy as np
+from scipy.integrate import solve_ivp
+from scipy.sparse import block_diag, csr_matrix, identity, kron
+
+from SPN_functions import compile_SPN, implicit_methods
+
+
+# ----- forward sensitivities -----
+
+# derivatives s_k = dy/dk of the trajectory with respect to rates k come
+# from one solve of the augmented system
+#     y' = N @ flux(y)
+#     s_k' = J(y) @ s_k + df/dk
+# where J is the exact Jacobian and, as the flux is linear in each rate,
+# df/dk = N[:, k] * flux_k(y) / k, i.e. the column of N times the flux
+# with unit rate.  the state is y followed by one s_k per rate, so
+# restricting wrt to the rates of interest keeps it small.  initial
+# sensitivities are zero (inits do not depend on the rates)
+
+# implicit methods get the block diagonal Jacobian diag(J, J, ..., J),
+# leaving out the (small) second derivative terms of the s_k rows
+
+# key function:
+#     sensitivity_SPN(G, inits, t0=0, t1=365, wrt=None)
+#     returns solve_ivp result with y (n_species, n_times) and
+#     sens (n_species, n_wrt, n_times)
+
+def _wrt_index(model, wrt):
+    if wrt is None:
+        return list(range(len(model.rates)))
+    idx = []
+    for name in wrt:
+        if name in model.params:
+            idx.append(model.params.index(name))
+        elif name in model.transactions:
+            idx.append(model.transactions.index(name))
+        else:
+            raise ValueError(f"No rate called {name}, expected one of {model.params}")
+    return idx
+
+
+def sensitivity_fun(G, params=None, wrt=None):
+    # OUTPUT: rate function of the augmented state (y, s_1, ..., s_p)
+    #         flattened, and its Jacobian function
+    model = compile_SPN(G)
+    rates = model.rates if params is None else np.asarray(params, dtype=float)
+    idx = _wrt_index(model, wrt)
+    n, p = len(model.species), len(idx)
+    N_wrt = model.N[:, idx]
+    if hasattr(N_wrt, 'toarray'):
+        N_wrt = N_wrt.toarray()
+    unit = np.zeros(len(rates))
+    unit[idx] = 1
+    N, flux, jac = model.N, model.flux, model.jac
+
+    def ratefun(t, z):
+        x = z[:n]
+        S = z[n:].reshape(n, p)
+        dS = jac(x, rates) @ S + N_wrt * flux(x, unit)[idx]
+        return np.concatenate((N @ flux(x, rates), dS.ravel()))
+
+    def jacfun(t, z):
+        # s is stored species-major, so the s rows are J acting on each
+        # column: kron(J, I_p)
+        J = csr_matrix(jac(z[:n], rates))
+        return block_diag([J, kron(J, identity(p), format='csr')], format='csr')
+
+    return ratefun, jacfun
+
+
+def sensitivity_SPN(G, inits, t0=0, t1=365, method='RK45', rtol=1e-9, atol=1e-12,
+                    params=None, wrt=None, t_eval=None):
+    # INPUT: graph G or CompiledSPN, as solve_SPN
+    #        wrt names of the rates (param or transaction names) to
+    #            differentiate by, default all of model.params
+    # OUTPUT: solve_ivp result with y, sens (n_species, n_wrt, n_times)
+    #         and wrt
+    model = compile_SPN(G)
+    idx = _wrt_index(model, wrt)
+    n, p = len(model.species), len(idx)
+    ratefun, jacfun = sensitivity_fun(model, params, wrt)
+    options = {}
+    if method in implicit_methods:
+        options['jac'] = jacfun if method != 'LSODA' else lambda t, z: jacfun(t, z).toarray()
+    z0 = np.concatenate((np.asarray(inits, dtype=float), np.zeros(n * p)))
+    sim = solve_ivp(ratefun, (t0, t1), z0, method=method, rtol=rtol, atol=atol,
+                    t_eval=t_eval, **options)
+    sim.sens = sim.y[n:].reshape(n, p, -1)
+    sim.y = sim.y[:n]
+    sim.wrt = [model.params[k] for k in idx]
+    return sim
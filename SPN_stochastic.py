@@ -0,0 +1,286 @@
+import math
+import random
+
+import numpy as np
+from scipy.optimize import OptimizeResult
+
+from SPN_functions import compile_SPN, daily_t_eval
+
+
+# ----- stochastic simulation of SPN graphs -----
+
+# the graphs are read as stochastic Petri nets on species counts.  a
+# transaction with rate k and inputs m_i fires with mass-action propensity
+#     k * volume^(1 - order) * prod_i x_i (x_i - 1) ... (x_i - m_i + 1)
+# where order = sum_i m_i and volume is the population size, so that for
+# large populations x / volume follows the rate equations of solve_SPN.
+
+# key function:
+#     gillespie_SPN(G, inits, t0=0, t1=365, t_eval=None, volume=None, seed=None)
+#     exact simulation by the next reaction method (Gibson and Bruck):
+#     each transaction keeps its own next firing time in an indexed
+#     priority queue, and after an event only the propensities that
+#     depend on the species it changed are recomputed
+
+def _reactant_lists(model):
+    # for each transaction, list of (species index, multiplicity)
+    return [[(i, int(m)) for i, m in enumerate(row) if m] for row in model.inputs]
+
+
+def _propensity_scale(model, rates, volume):
+    order = model.inputs.sum(axis=1)
+    return [float(k) * volume ** (1.0 - o) for k, o in zip(rates, order)]
+
+
+def dependency_graph(model):
+    # OUTPUT: for each transaction j, the transactions whose propensity
+    #         changes when j fires (including j itself if it does)
+    changed = [set(np.flatnonzero(model.N[:, j])) for j in range(len(model.transactions))]
+    uses = [set(np.flatnonzero(row)) for row in model.inputs]
+    return [[l for l in range(len(uses)) if uses[l] & changed[j]] for j in range(len(changed))]
+
+
+class IndexedPriorityQueue:
+    # binary min-heap of firing times, one per transaction, where the
+    # time of any transaction can be changed in O(log n)
+    def __init__(self, times):
+        self.times = list(times)
+        self.heap = sorted(range(len(self.times)), key=self.times.__getitem__)
+        self.pos = [0] * len(self.times)
+        for p, j in enumerate(self.heap):
+            self.pos[j] = p
+
+    def top(self):
+        j = self.heap[0]
+        return j, self.times[j]
+
+    def update(self, j, t):
+        old = self.times[j]
+        self.times[j] = t
+        if t < old:
+            self._sift_up(self.pos[j])
+        elif t > old:
+            self._sift_down(self.pos[j])
+
+    def _swap(self, p, q):
+        heap, pos = self.heap, self.pos
+        heap[p], heap[q] = heap[q], heap[p]
+        pos[heap[p]] = p
+        pos[heap[q]] = q
+
+    def _sift_up(self, p):
+        heap, times = self.heap, self.times
+        while p > 0:
+            parent = (p - 1) // 2
+            if times[heap[p]] < times[heap[parent]]:
+                self._swap(p, parent)
+                p = parent
+            else:
+                break
+
+    def _sift_down(self, p):
+        heap, times = self.heap, self.times
+        n = len(heap)
+        while True:
+            c = 2 * p + 1
+            if c >= n:
+                break
+            if c + 1 < n and times[heap[c + 1]] < times[heap[c]]:
+                c += 1
+            if times[heap[c]] < times[heap[p]]:
+                self._swap(p, c)
+                p = c
+            else:
+                break
+
+
+def gillespie_SPN(G, inits, t0=0, t1=365, t_eval=None, volume=None,
+                  params=None, seed=None, max_events=None):
+    # INPUT: graph G or CompiledSPN
+    #        inits integer species counts
+    #        t_eval output times, default every day from t0 to t1
+    #        volume population size for the propensities, default sum(inits)
+    #        params rates ordered as model.params, default the rates in G
+    # OUTPUT: OptimizeResult with t, y (n_species, n_times) counts at
+    #         t_eval, and n_events
+    model = compile_SPN(G)
+    if not model.mass_action:
+        raise ValueError("Stochastic simulation needs a mass-action model, e.g. a stratify_SPN graph")
+    rates = model.rates if params is None else np.asarray(params, dtype=float)
+    x = [int(v) for v in inits]
+    if len(x) != len(model.species):
+        raise ValueError(f"Expected {len(model.species)} counts {model.species}, got {len(x)}")
+    if volume is None:
+        volume = sum(x)
+    if t_eval is None:
+        t_eval = daily_t_eval(t0, t1)
+    t_eval = np.asarray(t_eval, dtype=float)
+
+    rng = random.Random(seed)
+    reactants = _reactant_lists(model)
+    scale = _propensity_scale(model, rates, volume)
+    changes = [[(i, int(d)) for i, d in enumerate(model.N[:, j]) if d]
+               for j in range(len(model.transactions))]
+    depends = dependency_graph(model)
+
+    def propensity(j):
+        a = scale[j]
+        for i, m in reactants[j]:
+            xi = x[i]
+            for r in range(m):
+                a *= xi - r
+        return a if a > 0 else 0.0
+
+    a = [propensity(j) for j in range(len(reactants))]
+    queue = IndexedPriorityQueue(
+        [t0 + rng.expovariate(aj) if aj > 0 else math.inf for aj in a])
+
+    y = np.empty((len(x), len(t_eval)))
+    k = 0
+    n_events = 0
+    stopped = False
+    while True:
+        j, t = queue.top()
+        if t > t1:
+            break
+        while k < len(t_eval) and t_eval[k] < t:
+            y[:, k] = x
+            k += 1
+        if max_events is not None and n_events >= max_events:
+            stopped = True
+            break
+        for i, d in changes[j]:
+            x[i] += d
+        n_events += 1
+        for l in depends[j]:
+            a_old = a[l]
+            a_new = propensity(l)
+            a[l] = a_new
+            if a_new == 0:
+                queue.update(l, math.inf)
+            elif l == j or a_old == 0:
+                queue.update(l, t + rng.expovariate(a_new))
+            else:
+                # reuse the remaining waiting time, rescaled
+                queue.update(l, t + (a_old / a_new) * (queue.times[l] - t))
+        if j not in depends[j]:
+            queue.update(j, t + rng.expovariate(a[j]) if a[j] > 0 else math.inf)
+    # after the last event the state is constant, unless we stopped early
+    y[:, k:] = np.nan if stopped else np.array(x)[:, None]
+
+    return OptimizeResult(t=t_eval, y=y, n_events=n_events)
+
+
+# ----- tau-leaping -----
+
+# approximate simulation for large populations: many replicates advance
+# together as (n_species, n_reps) arrays, each transaction firing a
+# Poisson number of times per leap.  each replicate picks its own leap
+# size tau so that no propensity is expected to change by more than
+# about epsilon (Cao, Gillespie and Petzold 2006), and a leap that would
+# make any count negative is thrown away and retried with half the tau.
+
+# key function:
+#     tau_leap_SPN(G, inits, n_reps=1000, t0=0, t1=365, t_eval=None, epsilon=0.03)
+#     returns result with t and y (n_reps, n_species, n_times) counts
+
+def _falling_offsets(model):
+    # for reactant slot k of transaction j, how many earlier slots of j
+    # hold the same species, so x - offset gives the falling factorial
+    offsets = np.zeros(model.reactants.shape, dtype=int)
+    for j, row in enumerate(model.reactants):
+        for k in range(1, len(row)):
+            offsets[j, k] = np.sum(row[:k] == row[k]) if row[k] < len(model.species) else 0
+    return offsets
+
+
+def tau_leap_SPN(G, inits, n_reps=1000, t0=0, t1=365, t_eval=None, volume=None,
+                 params=None, epsilon=0.03, seed=None, max_leaps=1000000):
+    # INPUT: graph G or CompiledSPN
+    #        inits integer species counts, shared by every replicate, or
+    #              (n_reps, n_species)
+    #        t_eval output times, default every day from t0 to t1
+    #        volume population size for the propensities, default the
+    #               total initial count
+    #        params rates ordered as model.params, default the rates in G
+    #        epsilon error control for the leap size
+    # OUTPUT: OptimizeResult with t, y (n_reps, n_species, n_times),
+    #         and per replicate n_leaps, n_rejected
+    model = compile_SPN(G)
+    if not model.mass_action:
+        raise ValueError("Stochastic simulation needs a mass-action model, e.g. a stratify_SPN graph")
+    rates = model.rates if params is None else np.asarray(params, dtype=float)
+    n_s = len(model.species)
+    inits = np.atleast_2d(np.asarray(inits, dtype=np.int64))
+    if inits.shape[1] != n_s:
+        raise ValueError(f"Expected {n_s} counts {model.species}, got {inits.shape[1]}")
+    if len(inits) > 1:
+        n_reps = len(inits)
+    x = np.array(np.broadcast_to(inits, (n_reps, n_s)).T)
+    if volume is None:
+        volume = x.sum(axis=0)
+    if t_eval is None:
+        t_eval = daily_t_eval(t0, t1)
+    t_eval = np.asarray(t_eval, dtype=float)
+    n_eval = len(t_eval)
+
+    rng = np.random.default_rng(seed)
+    order = model.inputs.sum(axis=1)
+    scale = rates[:, None] * np.asarray(volume, dtype=float) ** (1.0 - order[:, None])
+    slots = model._slots
+    offsets = [off for off in _falling_offsets(model).T]
+    N = model.N.astype(np.int64)
+    N2 = model.N**2
+    # highest order of any transaction using each species
+    g = np.array([order[model.inputs[:, i] > 0].max(initial=0) for i in range(n_s)], dtype=float)
+    reactant = g > 0
+
+    def propensities(x, scale):
+        xe = np.concatenate((x, np.ones((1, x.shape[1]), dtype=x.dtype)))
+        a = scale.copy()
+        for k, off in zip(slots, offsets):
+            a *= np.maximum(xe[k] - off[:, None], 0)
+        return a
+
+    y = np.full((n_reps, n_s, n_eval), np.nan)
+    k0 = np.searchsorted(t_eval, t0, side='right')
+    y[:, :, :k0] = x.T[:, :, None]
+    t = np.full(n_reps, float(t0))
+    idx = np.full(n_reps, k0)
+    shrink = np.ones(n_reps)
+    n_leaps = np.zeros(n_reps, dtype=int)
+    n_rejected = np.zeros(n_reps, dtype=int)
+
+    active = idx < n_eval
+    for _ in range(max_leaps):
+        r = np.flatnonzero(active)
+        if 0 == len(r):
+            break
+        xr = x[:, r]
+        a = propensities(xr, scale[:, r] if scale.shape[1] > 1 else scale)
+        mu = N @ a
+        sigma2 = N2 @ a
+        bound = np.maximum(epsilon * xr / np.maximum(g, 1)[:, None], 1)
+        with np.errstate(divide='ignore'):
+            tau = np.minimum(bound / np.abs(mu), bound**2 / sigma2)
+        tau = np.where(reactant[:, None], tau, np.inf).min(axis=0) * shrink[r]
+        target = t_eval[idx[r]]
+        hit = tau >= target - t[r]
+        tau = np.where(hit, target - t[r], tau)
+
+        x_new = xr + N @ rng.poisson(a * tau)
+        ok = (x_new >= 0).all(axis=0)
+        acc = r[ok]
+        x[:, acc] = x_new[:, ok]
+        t[acc] = np.where(hit[ok], target[ok], t[acc] + tau[ok])
+        shrink[acc] = 1
+        shrink[r[~ok]] /= 2
+        n_leaps[acc] += 1
+        n_rejected[r[~ok]] += 1
+
+        done = r[ok & hit]
+        y[done, :, idx[done]] = x[:, done].T
+        idx[done] += 1
+        active = idx < n_eval
+
+    return OptimizeResult(t=t_eval, y=y, n_leaps=n_leaps, n_rejected=n_rejected)
@@ -0,0 +1,245 @@
+import hashlib
+
+import numpy as np
+from scipy.sparse import csr_matrix, identity, kron
+
+from SPN_functions import CompiledSPN, compile_SPN
+
+
+# ----- stratified models -----
+
+# a base model (e.g. G_SIRDS) is copied once per group (age band, region,
+# ...).  transactions with a catalyst, a species that is both consumed and
+# produced like I in infect, mix between groups: group a's susceptibles
+# meet group b's infectious at rate times contact[a, b], and the new
+# infectious joins group a.  so G_SIRDS2 is G_SIRDS on groups ['y', 'o']
+# with base infect rate 1 and contact [[1.2, 0.2], [0.2, 0.3]], with death
+# rates [0.001, 0.009].
+
+# key functions:
+#     stratify_SPN(G, groups, contact, rates=None)
+#     returns the stratified graph, with one mixing transaction per pair
+#     of groups.  can be drawn, printed or simulated stochastically, but
+#     has O(N^2) transactions for N groups
+
+#     compile_stratified(G, groups, contact, rates=None)
+#     returns a StratifiedSPN, built straight from the base model with
+#     N copies of each transaction.  force of infection is computed as
+#     one contact matrix product, so this is the one to solve with
+
+# rates is a dict from base param names to one rate per group
+
+
+def _catalysts(model):
+    # OUTPUT: for each base transaction, the index of its catalyst
+    #         species or None
+    cats = []
+    for j in range(len(model.transactions)):
+        both = np.flatnonzero((model.inputs[j] > 0) & (model.outputs[j] > 0))
+        if len(both) > 1 or (len(both) == 1 and model.inputs[j, both[0]] > 1):
+            raise ValueError(f"Can only mix one catalyst in {model.transactions[j]}")
+        cats.append(int(both[0]) if len(both) else None)
+    return cats
+
+
+def _group_rates(model, groups, rates):
+    # OUTPUT: (n_groups, n_transactions) base rates, with overrides
+    R = np.tile(model.rates, (len(groups), 1))
+    for name, values in (rates or {}).items():
+        if name not in model.params:
+            raise ValueError(f"No rate called {name}, expected one of {model.params}")
+        values = np.asarray(values, dtype=float)
+        if values.shape != (len(groups),):
+            raise ValueError(f"Expected {len(groups)} values for {name}, got {values.shape}")
+        R[:, model.params.index(name)] = values
+    return R
+
+
+def _check_contact(groups, contact):
+    contact = np.asarray(contact, dtype=float)
+    if contact.shape != (len(groups), len(groups)):
+        raise ValueError(f"Expected {len(groups)}x{len(groups)} contact matrix, got {contact.shape}")
+    return contact
+
+
+def stratify_SPN(G, groups, contact, rates=None):
+    base = compile_SPN(G)
+    contact = _check_contact(groups, contact)
+    R = _group_rates(base, groups, rates)
+    cats = _catalysts(base)
+
+    # stack copies of the base layout, if there is one
+    pos = getattr(G, 'graph', {}).get('pos')
+    if pos is not None:
+        ys = [xy[1] for xy in pos.values()]
+        dy = max(ys) - min(ys) + 1
+        H_pos = {}
+
+    # networkx only here, so compile_stratified does not import it
+    import networkx as nx
+    H = nx.MultiDiGraph()
+    H.name = f"{base.name}_{len(groups)}"
+    for a, g in enumerate(groups):
+        H.add_nodes_from([f"{s}{g}" for s in base.species], type='species')
+        if pos is not None:
+            for s in base.species:
+                H_pos[f"{s}{g}"] = (pos[s][0], pos[s][1] + a * dy)
+
+    for a, ga in enumerate(groups):
+        for j, (t, p, tex) in enumerate(zip(base.transactions, base.params, base.latex)):
+            c = cats[j]
+            pairs = [(ga, a, R[a, j])] if c is None else \
+                [(ga + gb, b, R[a, j] * contact[a, b])
+                 for b, gb in enumerate(groups) if contact[a, b]]
+            for suffix, b, rate in pairs:
+                name = f"{t}_{suffix}"
+                H.add_node(name, rate=rate, type='transaction',
+                           latex=f"{tex}_{{{suffix}}}", var=f"{p}_{suffix}")
+                if pos is not None:
+                    H_pos[name] = (pos[t][0] + 0.2 * (b - a), pos[t][1] + a * dy)
+                for i, s in enumerate(base.species):
+                    n_in = base.inputs[j, i] - (i == c)
+                    n_out = base.outputs[j, i] - (i == c)
+                    H.add_edges_from([(f"{s}{ga}", name)] * int(n_in))
+                    H.add_edges_from([(name, f"{s}{ga}")] * int(n_out))
+                    if i == c:
+                        H.add_edge(f"{s}{groups[b]}", name)
+                        H.add_edge(name, f"{s}{groups[b]}")
+
+    if pos is not None:
+        H.graph['pos'] = H_pos
+    return H
+
+
+class StratifiedSPN(CompiledSPN):
+    # species are ordered group by group, e.g. Sy, Iy, Ry, Dy, So, ...,
+    # and so are transactions infect_y, recover_y, ..., infect_o, ...
+    # (infect_a covering infection of group a by every group).  inputs and
+    # outputs are those of the base model in each group, catalysts (Ia in
+    # infect_a) included, and N = (outputs - inputs).T.  the mixing of
+    # the catalysts is only in _src, which the flux and Jacobian use, so
+    # the generated code and LaTeX (which need mass action) refuse it
+    __slots__ = ('base', 'groups', 'contact', '_n_sb', '_n_tb', '_cat_species',
+                 '_src', '_mixed')
+
+    mass_action = False
+
+    def __init__(self, G, groups, contact, rates=None):
+        base = compile_SPN(G)
+        contact = _check_contact(groups, contact)
+        R = _group_rates(base, groups, rates)
+        cats = _catalysts(base)
+        n_g, n_sb, n_tb = len(groups), len(base.species), len(base.transactions)
+
+        self.base = base
+        self.groups = tuple(groups)
+        self.contact = contact
+        self.name = f"{base.name}_{n_g}"
+        self.key = hashlib.sha1(repr((base.key, self.groups)).encode()
+                                + contact.tobytes()).hexdigest()
+        self.species = tuple(f"{s}{g}" for g in groups for s in base.species)
+        self.transactions = tuple(f"{t}_{g}" for g in groups for t in base.transactions)
+        self.params = tuple(f"{p}_{g}" for g in groups for p in base.params)
+        self.latex = tuple(f"{tex}_{{{g}}}" for g in groups for tex in base.latex)
+
+        eye = np.eye(n_g, dtype=int)
+        self.inputs = np.kron(eye, base.inputs)
+        self.outputs = np.kron(eye, base.outputs)
+        self.N = csr_matrix(kron(identity(n_g), csr_matrix(base.N)))
+        self.reactants = base.reactants
+        self.rates = R.ravel()
+
+        # the flux of each base transaction is the product over its
+        # reactant slots of a column of source = [X, 1, contact @ X[:, cats]],
+        # X being the (n_groups, n_species) state.  _src gives the column
+        # for each slot, _mixed marks the catalyst slots
+        self._n_sb, self._n_tb = n_sb, n_tb
+        self._cat_species = np.array(sorted({c for c in cats if c is not None}), dtype=int)
+        src = np.array(base.reactants)
+        mixed = np.zeros(src.shape, dtype=bool)
+        for j, c in enumerate(cats):
+            if c is not None:
+                k = list(src[j]).index(c)
+                src[j, k] = n_sb + 1 + list(self._cat_species).index(c)
+                mixed[j, k] = True
+        self._src = [src[:, k] for k in range(src.shape[1])]
+        self._mixed = mixed
+        self._slots = base._slots
+        self.jac_sparsity = csr_matrix(self.jac(np.ones(n_g * n_sb)) != 0)
+
+        for a in (self.inputs, self.outputs, self.rates, self.contact):
+            a.flags.writeable = False
+        self._frozen = True
+
+    def _source(self, x):
+        n_g = len(self.groups)
+        X = np.asarray(x, dtype=float).reshape((n_g, self._n_sb) + np.shape(x)[1:])
+        Xe = np.concatenate((X, np.ones((n_g, 1) + X.shape[2:])), axis=1)
+        mix = np.tensordot(self.contact, X[:, self._cat_species], axes=1)
+        return np.concatenate((Xe, mix), axis=1)
+
+    def _group_flux(self, x, rates):
+        # OUTPUT: flux as (n_groups, n_base_transactions, ...)
+        source = self._source(x)
+        rates = np.asarray(rates).reshape((len(self.groups), self._n_tb) + np.shape(rates)[1:])
+        if source.ndim > rates.ndim + 1:
+            rates = rates[..., None]
+        f = rates * source[:, self._src[0]]
+        for k in self._src[1:]:
+            f = f * source[:, k]
+        return f
+
+    def flux(self, x, rates=None):
+        if rates is None:
+            rates = self.rates
+        f = self._group_flux(x, rates)
+        return f.reshape((-1,) + f.shape[2:])
+
+    def rate_fun(self, rates=None):
+        # (_group_flux inlined for the 1-d states solve_ivp passes)
+        if rates is None:
+            rates = self.rates
+        n_g, n_sb = len(self.groups), self._n_sb
+        rates = np.asarray(rates).reshape(n_g, self._n_tb)
+        NbT = self.base.N.T
+        contact, cats = self.contact, self._cat_species
+        ones = np.ones((n_g, 1))
+        first, rest = self._src[0], self._src[1:]
+        def ratefun(t, x0):
+            X = np.reshape(x0, (n_g, n_sb))
+            source = np.concatenate((X, ones, contact @ X[:, cats]), axis=1)
+            f = rates * source[:, first]
+            for k in rest:
+                f = f * source[:, k]
+            return (f @ NbT).ravel()
+        return ratefun
+
+    def jac(self, x, rates=None, sparse=False):
+        # d flux[a, j] / d x[b, c], then through the base stoichiometry
+        if rates is None:
+            rates = self.rates
+        n_g, n_sb, n_tb = len(self.groups), self._n_sb, self._n_tb
+        source = self._source(x)
+        rates = np.asarray(rates).reshape(n_g, n_tb)
+        vals = [source[:, k] for k in self._src]
+        D = np.zeros((n_g, n_tb, n_g, n_sb + 1))
+        g = np.arange(n_g)
+        for k, col in enumerate(self.base.reactants.T):
+            w = rates.copy()
+            for l, v in enumerate(vals):
+                if l != k:
+                    w = w * v
+            for j in range(n_tb):
+                if self._mixed[j, k]:
+                    D[:, j, :, col[j]] += w[:, j, None] * self.contact
+                else:
+                    D[g, j, g, col[j]] += w[:, j]
+        J = np.einsum('sj,ajbc->asbc', self.base.N, D[..., :n_sb])
+        J = J.reshape(n_g * n_sb, n_g * n_sb)
+        if sparse:
+            return csr_matrix(J)
+        return J
+
+
+def compile_stratified(G, groups, contact, rates=None):
+    return StratifiedSPN(G, groups, contact, rates)
@@ -0,0 +1,84 @@
+import numpy as np
+from numpy.lib.format import open_memmap
+from scipy.optimize import OptimizeResult
+
+from SPN_functions import compile_SPN, daily_t_eval, implicit_methods, solvers
+
+
+# ----- streaming solves for long horizons -----
+
+# solve_SPN keeps the whole solve_ivp result in memory.  here a single
+# solver is stepped by hand and each step is only used to interpolate
+# onto the requested output grid, so memory depends on the chunk size
+# and not on the horizon or the number of internal steps.
+
+# key functions:
+#     iter_SPN(G, inits, t0=0, t1=365, t_eval=None, chunk=1000)
+#     yields (t, y) blocks of at most chunk output times
+
+#     solve_SPN_stream(G, inits, filename, t0=0, t1=365, t_eval=None)
+#     writes y (n_species, n_times) to a .npy file as it goes, and
+#     returns a result whose y is that file, memory-mapped read-only
+
+def iter_SPN(G, inits, t0=0, t1=365, t_eval=None, chunk=1000, method='RK45',
+             sparse=False, rtol=1e-9, atol=1e-12, params=None):
+    # t_eval defaults to every day from t0 to t1
+    model = compile_SPN(G)
+    if params is not None:
+        params = np.asarray(params, dtype=float)
+    if t_eval is None:
+        t_eval = daily_t_eval(t0, t1)
+    t_eval = np.asarray(t_eval, dtype=float)
+    if len(t_eval) and t_eval[-1] > t1:
+        raise ValueError(f"t_eval goes up to {t_eval[-1]}, beyond t1={t1}")
+
+    options = {}
+    if method in implicit_methods:
+        options['jac'] = model.jac_fun(params, sparse=sparse and method != 'LSODA')
+    solver = solvers[method](model.rate_fun(params), t0, np.asarray(inits, dtype=float),
+                             t1, rtol=rtol, atol=atol, **options)
+
+    n_s = len(model.species)
+    k = 0
+    while k < len(t_eval) and t_eval[k] <= t0:
+        k += 1
+    block_t = list(t_eval[:k])
+    block_y = [np.asarray(inits, dtype=float)] * k
+    message = None
+    while k < len(t_eval):
+        if 'running' != solver.status:
+            raise RuntimeError(f"Solver {solver.status} at t={solver.t}, before "
+                               f"t={t_eval[k]}" + (f": {message}" if message else ""))
+        message = solver.step()
+        stop = np.searchsorted(t_eval, solver.t, side='right')
+        if stop > k:
+            dense = solver.dense_output()
+            ys = dense(t_eval[k:stop]).reshape(n_s, -1)
+            block_t.extend(t_eval[k:stop])
+            block_y.extend(ys.T)
+            k = stop
+        while len(block_t) >= chunk:
+            yield np.array(block_t[:chunk]), np.array(block_y[:chunk]).T
+            block_t, block_y = block_t[chunk:], block_y[chunk:]
+    if block_t:
+        yield np.array(block_t), np.array(block_y).T
+
+
+def solve_SPN_stream(G, inits, filename, t0=0, t1=365, t_eval=None, chunk=1000,
+                     method='RK45', sparse=False, rtol=1e-9, atol=1e-12, params=None):
+    model = compile_SPN(G)
+    if t_eval is None:
+        t_eval = daily_t_eval(t0, t1)
+    t_eval = np.asarray(t_eval, dtype=float)
+
+    # Fortran order so that each block of times is contiguous on disk
+    y = open_memmap(filename, mode='w+', dtype=float, fortran_order=True,
+                    shape=(len(model.species), len(t_eval)))
+    k = 0
+    for ts, ys in iter_SPN(model, inits, t0, t1, t_eval, chunk, method,
+                           sparse, rtol, atol, params):
+        y[:, k:k + len(ts)] = ys
+        k += len(ts)
+    y.flush()
+    del y
+    return OptimizeResult(t=t_eval, y=np.load(filename, mmap_mode='r'), success=True)
@@ -0,0 +1,217 @@
+import itertools
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from functools import partial
+from multiprocessing.shared_memory import SharedMemory
+
+import numpy as np
+from scipy.optimize import OptimizeResult
+
+from SPN_functions import (compile_SPN, daily_t_eval, infected_species, solve_SPN,
+                           summary_SPN)
+from SPN_ensemble import solve_SPN_batch
+from SPN_results import ResultCache
+
+
+# ----- parameter sweeps over a process pool -----
+
+# key functions:
+#     param_grid(*values)
+#     every combination of the given values, one row per run
+#     (the general form of testparams in model-sim_classes.py)
+
+#     run_sweep(G, params, inits, metrics=None, chunksize=256)
+#     solves every row of params in chunks across processes.  workers
+#     write straight into a shared memory array, row i always being
+#     params[i], and only a success flag is sent back.  with a
+#     checkpoint file, finished chunks are saved and skipped on rerun
+
+def param_grid(*values):
+    return np.array(list(itertools.product(*values)), dtype=float)
+
+
+# ----- summary metrics -----
+
+# a metric is called as metric(model, t, y), y being (n_runs, n_species,
+# n_times), and returns one number per run.  use partial to fix the
+# species so that metrics can be sent to worker processes
+
+def final_value(model, t, y, spec):
+    return y[:, model.species.index(spec), -1]
+
+def peak_value(model, t, y, spec):
+    return y[:, model.species.index(spec)].max(axis=1)
+
+def peak_time(model, t, y, spec):
+    return t[y[:, model.species.index(spec)].argmax(axis=1)]
+
+SIRDS_metrics = {'finalD': partial(final_value, spec='D'),
+                 'peakI': partial(peak_value, spec='I'),
+                 'peak_time': partial(peak_time, spec='I')}
+
+
+# with method='summary' each run is solved by summary_SPN instead, which
+# stores nothing and stops at extinction or equilibrium.  the metrics are
+# then fixed: the final value of each species, the peak and peak time of
+# the infected species and the extinction time (nan if none)
+
+def summary_names(model):
+    return [f"final{s}" for s in model.species] + ['peak', 'peak_time', 'extinction_time']
+
+
+# ----- workers -----
+
+def _summary_chunk(model, params, inits, t0, t1, rtol, atol):
+    out = np.full((len(params), len(model.species) + 3), np.nan)
+    success = np.zeros(len(params), dtype=bool)
+    infected = infected_species(model)
+    for i in range(len(params)):
+        res = summary_SPN(model, inits[i], t0, t1, infected, rtol=rtol, atol=atol,
+                          params=params[i])
+        if res.success:
+            out[i, :-3] = res.final
+            out[i, -3:] = res.peak, res.peak_time, \
+                np.nan if res.extinction_time is None else res.extinction_time
+            success[i] = True
+    return out, success
+
+
+def _solve_chunk(model, params, inits, t0, t1, t_eval, method, rtol, atol):
+    if 'batch' == method:
+        res = solve_SPN_batch(model, params, inits, t0, t1, t_eval, rtol=rtol, atol=atol)
+        return res.y, res.success
+    y = np.full((len(params), len(model.species), len(t_eval)), np.nan)
+    success = np.zeros(len(params), dtype=bool)
+    for i in range(len(params)):
+        sim = solve_SPN(model, inits[i], t0, t1, method=method, rtol=rtol,
+                        atol=atol, params=params[i], t_eval=t_eval)
+        if sim.success:
+            y[i] = sim.y
+            success[i] = True
+    return y, success
+
+
+def _run_chunk(shm_name, shape, start, stop, model, params, inits, t0, t1,
+               t_eval, metrics, method, rtol, atol):
+    if 'summary' == method:
+        y, success = _summary_chunk(model, params, inits, t0, t1, rtol, atol)
+    else:
+        y, success = _solve_chunk(model, params, inits, t0, t1, t_eval, method, rtol, atol)
+    shm = SharedMemory(name=shm_name)
+    try:
+        out = np.ndarray(shape, dtype=float, buffer=shm.buf)
+        if 'summary' == method:
+            out[start:stop] = y
+        elif metrics:
+            out[start:stop] = np.column_stack([m(model, t_eval, y) for m in metrics.values()])
+        else:
+            out[start:stop] = y
+        del out
+    finally:
+        shm.close()
+    return start, success
+
+
+# ----- sweep -----
+
+def run_sweep(G, params, inits, t0=0, t1=365, t_eval=None, metrics=None,
+              method='batch', rtol=1e-6, atol=1e-9, chunksize=256,
+              max_workers=None, progress=None, checkpoint=None,
+              checkpoint_every=10):
+    # INPUT: graph G or CompiledSPN
+    #        params (n_runs, n_params), ordered as model.params
+    #        inits (n_runs, n_species), or one row for every run
+    #        metrics dict name -> metric; if None, whole trajectories on
+    #                t_eval (default every day) are returned
+    #        method 'batch' for solve_SPN_batch on each chunk, 'summary'
+    #               for summary_SPN run by run (metrics are then
+    #               summary_names(model)), otherwise a solve_ivp method
+    #               for solve_SPN run by run
+    #        progress function progress(runs_done, n_runs)
+    #        checkpoint .npz file for partial results, saved at most
+    #                   every checkpoint_every seconds and at the end, and
+    #                   only resumed from if everything the results depend
+    #                   on (model, params, inits, times, method, tolerances,
+    #                   metric names, chunksize) is the same
+    # OUTPUT: OptimizeResult with t, y (n_runs, n_species, n_times) or
+    #         metrics (n_runs, n_metrics), metric_names, success
+    model = compile_SPN(G)
+    params = np.atleast_2d(np.asarray(params, dtype=float))
+    n_runs = len(params)
+    inits = np.array(np.broadcast_to(np.atleast_2d(np.asarray(inits, dtype=float)),
+                                     (n_runs, len(model.species))))
+    if t_eval is None:
+        t_eval = daily_t_eval(t0, t1)
+    t_eval = np.asarray(t_eval, dtype=float)
+
+    if 'summary' == method:
+        metrics = dict.fromkeys(summary_names(model))
+        shape = (n_runs, len(metrics))
+    elif metrics:
+        shape = (n_runs, len(metrics))
+    else:
+        shape = (n_runs, len(model.species), len(t_eval))
+    starts = list(range(0, n_runs, chunksize))
+    done = np.zeros(len(starts), dtype=bool)
+    success = np.zeros(n_runs, dtype=bool)
+
+    shm = SharedMemory(create=True, size=max(int(np.prod(shape)) * 8, 1))
+    try:
+        out = np.ndarray(shape, dtype=float, buffer=shm.buf)
+        out[:] = np.nan
+        if checkpoint is not None:
+            # np.savez adds .npz to other names
+            if not checkpoint.endswith('.npz'):
+                checkpoint += '.npz'
+            key = ResultCache.key(model.key, params, inits, t0, t1, t_eval, method,
+                                  rtol, atol, list(metrics or ()), chunksize)
+        if checkpoint is not None and os.path.exists(checkpoint):
+            saved = np.load(checkpoint)
+            if 'key' in saved and str(saved['key']) == key and saved['out'].shape == shape:
+                out[:] = saved['out']
+                done[:] = saved['done']
+                success[:] = saved['success']
+
+        def save():
+            if checkpoint is not None:
+                np.savez(checkpoint, out=out, done=done, success=success, params=params,
+                         key=key)
+
+        n_done = sum(min(s + chunksize, n_runs) - s for s, d in zip(starts, done) if d)
+        if progress is not None:
+            progress(n_done, n_runs)
+        last_save = time.monotonic()
+        try:
+            with ProcessPoolExecutor(max_workers=max_workers) as pool:
+                futures = []
+                for c, start in enumerate(starts):
+                    if done[c]:
+                        continue
+                    stop = min(start + chunksize, n_runs)
+                    futures.append(pool.submit(
+                        _run_chunk, shm.name, shape, start, stop, model,
+                        params[start:stop], inits[start:stop], t0, t1, t_eval,
+                        metrics, method, rtol, atol))
+                for fut in as_completed(futures):
+                    start, chunk_success = fut.result()
+                    success[start:start + len(chunk_success)] = chunk_success
+                    done[start // chunksize] = True
+                    n_done += len(chunk_success)
+                    if progress is not None:
+                        progress(n_done, n_runs)
+                    if time.monotonic() - last_save > checkpoint_every:
+                        save()
+                        last_save = time.monotonic()
+        finally:
+            save()
+        result = np.array(out)
+        del out
+    finally:
+        shm.close()
+        shm.unlink()
+
+    if metrics:
+        return OptimizeResult(t=t_eval, metrics=result, metric_names=list(metrics),
+                              success=success, params=params)
+    return OptimizeResult(t=t_eval, y=result, success=success, params=params)
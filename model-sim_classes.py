@@ -1,5 +1,8 @@
-from scipy.integrate import solve_ivp
 import matplotlib.pyplot as plt
+import numpy as np
+
+import model_graphs
+from SPN_functions import compile_SPN, infected_species, solve_SPN, species, summary_SPN
 
 
 # # class of model
@@ -24,52 +27,154 @@ class Models:
 mods = Models()
 
 # class of simulation
+
+# model is any SPN graph or CompiledSPN, or the name of one in
+# model_graphs.py ("SIRDS" for G_SIRDS); params are ordered as
+# model.params, default the rates in the graph.  nothing is solved until
+# a result is used: ts, data, backsums and summary are computed on first
+# access and kept.  solve() and calc_backsums() can still be called, but
+# are not needed
+
+# default colours and alphas for plot_on_axis, by species name
+sim_cols = {'S': 'black', 'I': 'red', 'R': 'green', 'D': 'black'}
+sim_alphas = {'S': 0.1, 'I': 0.4, 'R': 0.2, 'D': 0.5}
+
 class Sim:
-    def __init__(self, model_name, params, inits, t1, t0=0):
-        self.model = model_name
-        self.params = params
+    __slots__ = ('model', 'params', 'inits', 'n_var', 't0', 't1', 'stats',
+                 '_sim', '_backsums', '_summary')
+
+    def __init__(self, model, params, inits, t1, t0=0):
+        if isinstance(model, str):
+            model = getattr(model_graphs, 'G_' + model)
+        self.model = compile_SPN(model)
+        self.params = None if params is None else tuple(params)
         self.inits = inits
         self.n_var = len(inits)
         self.t0 = t0
         self.t1 = t1
-        self.solved = False
-        self.backsums_calc = False
-    
-    def solve(self):
-        sim = solve_ivp(getattr(mods, self.model), 
-                        t_span=(self.t0, self.t1), 
-                        y0=self.inits, args=self.params, 
-                        method='RK45', rtol=1e-9, atol=1e-12)
-        if sim.success:
-            self.solved = True
-            self.ts = sim.t
-            self.data = sim.y
-            self.finalD = self.data[-1][-1]
-        else:
+        self.stats = None
+        self._sim = None
+        self._backsums = None
+        self._summary = None
+
+    def solve(self, stats=False):
+        # with stats=True (or a hook added in SPN_functions), sets self.stats
+        if self._sim is None or stats:
+            sim = solve_SPN(self.model, self.inits, self.t0, self.t1,
+                            params=self.params, stats=stats)
+            self.stats = getattr(sim, 'stats', None)
+            self._sim = sim
+        if not self._sim.success:
             return False
-    
-    def calc_backsums(self):
-        if self.backsums_calc:
-            return -1
-        elif self.solved:            
-            backsums = [self.data[-1]]
-            for i in range(self.n_var-1):
-                backsums.append(backsums[-1]+self.data[2-i])
-            
-            self.backsums = backsums
-            self.backsums_calc = True
-        else:
-            return -2
-    
-    def plot_on_axis(self, ax):
-        if self.solved:
-            ax.fill_between(self.ts, self.backsums[2], self.backsums[3], color='black', label='S', alpha=0.1)
-            ax.fill_between(self.ts, self.backsums[1], self.backsums[2], color='red',   label='I', alpha=0.4)
-            ax.fill_between(self.ts, self.backsums[0], self.backsums[1], color='green', label='R', alpha=0.2)
-            ax.fill_between(self.ts, 0,                self.backsums[0], color='black', label='D', alpha=0.5)
 
-            for i in range(self.n_var-1):
-                ax.plot(self.ts, self.backsums[i], color='black', linewidth=0.8)
+    @property
+    def solved(self):
+        return self._sim is not None and self._sim.success
+
+    def _result(self):
+        if self._sim is None:
+            self.solve()
+        if not self._sim.success:
+            raise RuntimeError(f"Solve failed: {self._sim.message}")
+        return self._sim
+
+    @property
+    def ts(self):
+        return self._result().t
+
+    @property
+    def data(self):
+        return self._result().y
+
+    @property
+    def backsums(self):
+        # backsums[i] = data[-1] + ... + data[-1-i]
+        if self._backsums is None:
+            self._backsums = np.cumsum(np.asarray(self.data)[::-1], axis=0)
+        return self._backsums
+
+    def calc_backsums(self):
+        return self.backsums
+
+    @property
+    def summary(self):
+        # dict of final value of each species, and peak and peak time of
+        # the infected species, from the trajectory
+        if self._summary is None:
+            infected = [self.model.species.index(s) for s in infected_species(self.model)]
+            I = np.asarray(self.data)[infected].sum(axis=0)
+            k = int(np.argmax(I))
+            self._summary = dict(zip(self.model.species, np.asarray(self.data)[:, -1]))
+            self._summary.update(peak=float(I[k]), peak_time=float(self.ts[k]))
+        return self._summary
+
+    @property
+    def finalD(self):
+        return self.data[-1][-1]
+
+    def summarise(self, threshold=1e-8, eq_tol=1e-10):
+        # summary-only solve: stops once infection dies out or settles, and
+        # keeps no trajectory (see summary_SPN)
+        res = summary_SPN(self.model, self.inits, self.t0, self.t1, threshold=threshold,
+                          eq_tol=eq_tol, params=self.params)
+        if not res.success:
+            return False
+        return res
+
+    def plot_on_axis(self, ax, cols=None, alphas=None):
+        specs = species(self.model)
+        n = len(specs)
+        cols = sim_cols if cols is None else cols
+        alphas = sim_alphas if alphas is None else alphas
+        ts, backsums = self.ts, self.backsums
+        for i, s in enumerate(specs):
+            lower = backsums[n-2-i] if i < n-1 else 0
+            ax.fill_between(ts, lower, backsums[n-1-i], color=cols.get(s), label=s,
+                            alpha=alphas.get(s, 0.3))
+        ax.plot(ts, backsums[:n-1].T, color='black', linewidth=0.8)
+
+
+# grid of simulations, e.g. for comparing parameter sets side by side.
+# cells are Sims, so only the cells that are plotted or queried are solved
+
+class SimGrid:
+    __slots__ = ('sims',)
+
+    def __init__(self, model, params, inits, t1, t0=0):
+        # params: nested list, params[i][j] for the cell in row i, column j
+        self.sims = [[Sim(model, p, inits, t1, t0) for p in row] for row in params]
+
+    @property
+    def shape(self):
+        return len(self.sims), len(self.sims[0])
+
+    def __getitem__(self, ij):
+        i, j = ij
+        return self.sims[i][j]
+
+    def finalD(self, cells=None):
+        # nested list of finalD, or a dict for the given (i, j) cells
+        if cells is not None:
+            return {(i, j): self.sims[i][j].finalD for i, j in cells}
+        return [[sim.finalD for sim in row] for row in self.sims]
+
+    def plot(self, cells=None, save=-1, figsize=None):
+        # INPUT: cells list of (i, j) to plot, default all
+        #        save filename without extension, saved as .svg
+        # OUTPUT: finalD of the plotted cells, as for finalD
+        n, m = self.shape
+        fig, axs = plt.subplots(n, m, figsize=figsize, squeeze=False)
+        for i in range(n):
+            for j in range(m):
+                if cells is None or (i, j) in cells:
+                    self.sims[i][j].plot_on_axis(axs[i][j])
+                else:
+                    axs[i][j].axis('off')
+        if not save==-1:
+            fname = save+".svg"
+            plt.savefig(fname)
+        plt.show()
+        return self.finalD(cells)
 
 
 # beta = 0.6      # infection rate
@@ -79,12 +184,10 @@ class Sim:
 #           (0.6, 0.12, 0.004, 0.006), 
 
 
-def SIRDS365(params):
-    return Sim("SIRDS", params,
-           (1-0.00000003, 0.00000003, 0, 0),
-           365)
-
+SIRDS_inits = (1-0.00000003, 0.00000003, 0, 0)
 
+def SIRDS365(params):
+    return Sim("SIRDS", params, SIRDS_inits, 365)
 
 
 # for i in range(2):
@@ -95,10 +198,8 @@ def SIRDS365(params):
 
 
 def plot365(params):
-    tempsim = Sim("SIRDS", params, (1-0.00000003, 0.00000003, 0, 0), 365)
+    tempsim = SIRDS365(params)
     fig, ax = plt.subplots(1)
-    tempsim.solve()
-    tempsim.calc_backsums()
     tempsim.plot_on_axis(ax)
     # plt.legend(loc=(0.86,0.7)) # top right
     # plt.legend(loc=(0.06, 0.7)) # top left
@@ -107,38 +208,9 @@ def plot365(params):
 
 
 def plotfour365(pps, save=-1):
+    # 2x2 grid of SIRDS365 runs; see SimGrid for other sizes
     p1,p2,p3,p4 = pps
-    sims = [[0,0],[0,0]]
-    sims[0][0] = SIRDS365(p1)
-    sims[0][1] = SIRDS365(p2)
-    sims[1][0] = SIRDS365(p3)
-    sims[1][1] = SIRDS365(p4)
-
-    for i in range(2):
-        for j in range(2):
-            sims[i][j].solve()
-            sims[i][j].calc_backsums()
-
-    plt.figure(figsize=(12, 12))
-
-    fig, axs = plt.subplots(2, 2)
-    
-    finD = [[0,0],[0,0]]
-
-
-    for i in range(2):
-        for j in range(2):
-            sims[i][j].plot_on_axis(axs[i][j])
-            finD[i][j] = sims[i][j].finalD
-
-    
-    if not save==-1:
-        fname = save+".svg"
-        plt.savefig(fname)
-
-    plt.show()
-        
-    return finD
+    return SimGrid("SIRDS", [[p1, p2], [p3, p4]], SIRDS_inits, 365).plot(save=save)
 
     
 testparams = ((0.6, 0.12, 0.004, 0.006),